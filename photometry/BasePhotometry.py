@@ -439,7 +439,8 @@ class BasePhotometry(object):
 		if self.tpf:
 			self.tpf.close()
 
-	def clear_cache(self):
+	@staticmethod
+	def clear_cache():
 		"""Clear internal cache"""
 		global hdf5_cache
 		hdf5_cache = {}
@@ -7,7 +7,7 @@ from .AperturePhotometry import AperturePhotometry
 from .psf_photometry import PSFPhotometry
 from .linpsf_photometry import LinPSFPhotometry
 from .halo import HaloPhotometry
-from .tessphot import tessphot
+from .tessphot import tessphot, tessphot_batch, tessphot_chunk, tessphot_many, dask_tessphot, PhotResult
 from .taskmanager import TaskManager
 from .image_motion import ImageMovementKernel
 from .quality import TESSQualityFlags, PixelQualityFlags, CorrectorQualityFlags
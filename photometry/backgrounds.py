@@ -8,7 +8,9 @@ Estimation of sky background in TESS Full Frame Images.
 
 import logging
 import warnings
+import functools
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from astropy.utils.exceptions import AstropyDeprecationWarning
 warnings.filterwarnings('ignore', category=AstropyDeprecationWarning, module='photutils')
 from astropy.stats import SigmaClip
@@ -19,6 +21,14 @@ from statsmodels.nonparametric.kde import KDEUnivariate as KDE
 from .utilities import load_ffi_fits, move_median_central
 from .pixel_flags import pixel_manual_exclude
 
+# SEP provides a much faster C implementation of the SExtractor background
+# estimator. If it is not available, we fall back to using photutils:
+try:
+	import sep
+	HAS_SEP = True
+except ImportError: # pragma: no cover
+	HAS_SEP = False
+
 #------------------------------------------------------------------------------
 def _reduce_mode(x):
 	if len(x) == 0:
@@ -45,9 +55,61 @@ class ModeBackground(BackgroundBase):
 		bkg = np.atleast_1d(_mode(np.asarray(data, dtype=np.float64)))
 		return bkg
 
+#------------------------------------------------------------------------------
+def _fit_strip(img, mask, sigma_clip=None, bkg_estimator=None):
+	"""
+	Run the 2D square tiles background estimation on a (strip of an) image.
+
+	Uses SEP if it is available, otherwise photutils ``Background2D``.
+	"""
+	if HAS_SEP:
+		# SEP requires a C-contiguous native-endian float32 array
+		# and the mask as an uint8 image, where non-zero pixels are masked out:
+		img = np.ascontiguousarray(img, dtype='float32')
+		mask = np.ascontiguousarray(mask, dtype='uint8')
+		bkg = sep.Background(img, mask=mask, bw=64, bh=64, fw=3, fh=3)
+		return bkg.back()
+
+	bkg = Background2D(img, (64, 64),
+		filter_size=(3, 3),
+		sigma_clip=sigma_clip,
+		bkg_estimator=bkg_estimator,
+		mask=mask,
+		exclude_percentile=50)
+	return bkg.background
+
+#------------------------------------------------------------------------------
+def _fit_strip_overlap(edges, img, mask, i, overlap=128, **kwargs):
+	# Fit the strip padded with the overlap, and crop it again afterwards:
+	r1 = max(edges[i] - overlap, 0)
+	r2 = min(edges[i+1] + overlap, img.shape[0])
+	bkg = _fit_strip(img[r1:r2, :], mask[r1:r2, :], **kwargs)
+	return bkg[edges[i]-r1:edges[i+1]-r1, :]
+
+#------------------------------------------------------------------------------
+def _fit_square_background(img, mask, strips=1, **kwargs):
+	"""
+	2D square tiles background estimation, optionally split into row-strips.
+
+	If ``strips`` is larger than one, the image is split into that number of row-strips,
+	aligned with the 64x64 pixel mesh, which are processed in parallel threads and stitched
+	together again. Each strip is padded with two meshes from the neighbouring strips,
+	to avoid edge-effects from the filtering and interpolation between the meshes.
+	"""
+	if strips <= 1:
+		return _fit_strip(img, mask, **kwargs)
+
+	nrows = img.shape[0]
+	edges = [min(64*int(round(nrows*i/(64*strips))), nrows) for i in range(strips+1)]
+	edges[-1] = nrows
+
+	worker = functools.partial(_fit_strip_overlap, edges, img, mask, **kwargs)
+	with ThreadPoolExecutor(max_workers=strips) as executor:
+		return np.concatenate(list(executor.map(worker, range(strips))), axis=0)
+
 #------------------------------------------------------------------------------
 def fit_background(image, catalog=None, flux_cutoff=8e4,
-		bkgiters=3, radial_cutoff=2400, radial_pixel_step=15, radial_smooth=3):
+		bkgiters=3, radial_cutoff=2400, radial_pixel_step=15, radial_smooth=3, strips=1):
 	"""
 	Estimate background in Full Frame Image.
 
@@ -63,6 +125,8 @@ def fit_background(image, catalog=None, flux_cutoff=8e4,
 		radial_cutoff (float): Radial distance in pixels from camera centre to start using radial component. Default=2400.
 		radial_pixel_step (integer): Step sizes to use in radial component. Default=15.
 		radial_smooth (integer): Width of median smoothing on radial profile. Default=3.
+		strips (integer): Number of row-strips to split the image into for the 2D square tiles
+			background estimation. The strips are processed in parallel threads. Default=1.
 
 	Returns:
 		ndarray: Estimated background with the same size as the input image.
@@ -104,8 +168,11 @@ def fit_background(image, catalog=None, flux_cutoff=8e4,
 		return np.full_like(img0, np.NaN), mask
 
 	# Setup background estimator:
-	sigma_clip = SigmaClip(sigma=3.0, maxiters=5)
-	bkg_estimator = SExtractorBackground(sigma_clip)
+	# The string names dispatch to the fast nan-functions (using bottleneck
+	# if available) instead of the slow masked arrays. Passing the bottleneck
+	# functions directly does not work, since Background2D calls them with a tuple axis:
+	sigma_clip = SigmaClip(sigma=3.0, maxiters=5, cenfunc='median', stdfunc='std')
+	bkg_estimator = SExtractorBackground(sigma_clip=sigma_clip)
 
 	# Create distance-image with distances (in pixels) from the camera centre:
 	use_radial_component = True
@@ -195,13 +262,10 @@ def fit_background(image, catalog=None, flux_cutoff=8e4,
 				img_bkg_radial = 0
 
 		# Run 2D square tiles background estimation:
-		bkg = Background2D(img0 - img_bkg_radial, (64, 64),
-			filter_size=(3, 3),
+		img_bkg_square = _fit_square_background(img0 - img_bkg_radial, mask,
+			strips=strips,
 			sigma_clip=sigma_clip,
-			bkg_estimator=bkg_estimator,
-			mask=mask,
-			exclude_percentile=50)
-		img_bkg_square = bkg.background
+			bkg_estimator=bkg_estimator)
 
 	# Total background image:
 	img_bkg = img_bkg_radial + img_bkg_square
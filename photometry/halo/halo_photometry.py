@@ -10,6 +10,7 @@ Halo Photometry.
 import logging
 import os.path
 import numpy as np
+from numba import njit
 from ..plots import plt, save_figure
 from .. import BasePhotometry, STATUS
 from ..utilities import mag2flux
@@ -17,6 +18,32 @@ import halophot
 from halophot.halo_tools import do_lc
 from astropy.table import Table
 
+#--------------------------------------------------------------------------------------------------
+@njit(cache=True)
+def _find_single_gap(t, tmin, ttot, gap_thresh=0.5):
+	"""
+	Find a single large gap in the central part of a timeseries.
+
+	Parameters:
+		t (ndarray): Sorted timestamps.
+		tmin (float): First timestamp.
+		ttot (float): Total timespan of the timeseries.
+		gap_thresh (float): Minimum length of gap. Default=0.5.
+
+	Returns:
+		int: Index of the timestamp just before the gap, if exactly one gap was found
+			within the central 40% of the timeseries. Otherwise -1.
+	"""
+	t1 = tmin + 0.30*ttot
+	t2 = tmin + 0.70*ttot
+	found = -1
+	count = 0
+	for i in range(len(t)-1):
+		if t1 < t[i] < t2 and t[i+1] - t[i] > gap_thresh:
+			found = i
+			count += 1
+	return found if count == 1 else -1
+
 #--------------------------------------------------------------------------------------------------
 class HaloPhotometry(BasePhotometry):
 	"""Use halo photometry to observe very saturated stars.
@@ -128,12 +155,10 @@ class HaloPhotometry(BasePhotometry):
 			# to clever, and just don't split the timeseries.
 			timecorr = self.lightcurve['timecorr'][indx_goodtimes]
 			t = self.lightcurve['time'][indx_goodtimes] - timecorr
-			dt = np.append(np.diff(t), 0)
 			t0 = np.nanmin(t)
 			Ttot = np.nanmax(t) - t0
-			indx = (t0+0.30*Ttot < t) & (t < t0+0.70*Ttot) & (dt > 0.5)
-			if np.sum(indx) == 1:
-				indx = np.where(indx)[0][0]
+			indx = _find_single_gap(np.asarray(t, dtype='float64'), t0, Ttot)
+			if indx >= 0:
 				thole = 0.5*(t[indx] + t[indx+1]) + timecorr[indx]
 				logger.info("Automatically found split: %f", thole)
 				split_times = (thole,)
@@ -183,15 +208,20 @@ class HaloPhotometry(BasePhotometry):
 			self.lightcurve['flux'][indx_goodtimes] = ts['corr_flux'] * normfactor
 
 			# Create mapping from each cadence to which weightmap was used:
-			wmindx = np.zeros_like(indx_goodtimes, dtype=int)
-			for k, (cad1, cad2) in enumerate(zip(weightmap_dict['initial_cadence'], weightmap_dict['final_cadence'])):
-				wmindx[(self.lightcurve['cadenceno'] >= cad1) & (self.lightcurve['cadenceno'] <= cad2)] = k
+			# The segments are sorted and contiguous, so the weightmap for each cadence
+			# is the last one starting at or before the cadence.
+			init_cads = np.asarray(weightmap_dict['initial_cadence'])
+			wmindx = np.searchsorted(init_cads, self.lightcurve['cadenceno'], side='right') - 1
+			wmindx = np.clip(wmindx, 0, len(init_cads)-1)
 
 			# Calculate the flux error by uncertainty propergation:
-			for k, imgerr in enumerate(self.images_err):
-				if not indx_goodtimes[k]: continue
-				wm = weightmap_dict['weightmap'][wmindx[k]] # Get the weightmap for this cadence
-				self.lightcurve['flux_err'][k] = np.abs(normfactor) * np.sqrt(np.sum( wm**2 * imgerr**2 ))
+			# This is done for all cadences using the same weightmap at once.
+			for k, wm in enumerate(weightmap_dict['weightmap']):
+				indx = np.where(indx_goodtimes & (wmindx == k))[0]
+				if len(indx) == 0: continue
+				wm2 = np.asarray(wm, dtype='float64')**2
+				imgerr2 = np.asarray(self.images_err_cube[:, :, indx], dtype='float64')**2
+				self.lightcurve['flux_err'][indx] = np.abs(normfactor) * np.sqrt(np.einsum('ij,ijk->k', wm2, imgerr2))
 
 			self.lightcurve['pos_centroid'][:,0] = col # we don't actually calculate centroids
 			self.lightcurve['pos_centroid'][:,1] = row
@@ -213,10 +243,12 @@ class HaloPhotometry(BasePhotometry):
 				norm = np.size(weightmap_dict['weightmap'][0])
 				cmap.set_bad('k', 1.)
 				for k, wm in enumerate(weightmap_dict['weightmap']):
-					im = np.log10(wm*norm)
+					# Pixels with non-positive weights are left as NaN:
+					im = np.log10(wm*norm, where=(wm > 0), out=np.full_like(wm, np.nan, dtype='float64'))
+					vmax = 2*np.nanmax(im)
 					fig = plt.figure()
 					ax = fig.add_subplot(111)
-					plt.imshow(im, cmap=cmap, vmin=-2*np.nanmax(im), vmax=2*np.nanmax(im),
+					plt.imshow(im, cmap=cmap, vmin=-vmax, vmax=vmax,
 						interpolation='None', origin='lower')
 					plt.colorbar()
 					ax.set_title('TV-min Weightmap')
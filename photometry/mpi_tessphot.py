@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scheduler using MPI for running the TESS photometry
+pipeline on a large scale multi-core computer.
+
+The setup uses the task-pull paradigm for high-throughput computing
+using ``mpi4py``. Task pull is an efficient way to perform a large number of
+independent tasks when there are more tasks than processors, especially
+when the run times vary for each task.
+
+The basic example was inspired by
+https://github.com/jbornschein/mpi4py-examples/blob/master/09-task-pull.py
+
+.. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
+"""
+
+from mpi4py import MPI
+import logging
+import enum
+import random
+from timeit import default_timer
+from . import TaskManager, tessphot
+
+# Define MPI message tags
+tags = enum.IntEnum('tags', ('READY', 'DONE', 'EXIT', 'START'))
+
+#------------------------------------------------------------------------------
+def _shuffled_tasks(tm):
+	"""
+	Iterate through the tasks of the TODO-list in random order.
+
+	The TODO-list is only read and shuffled once, when the iteration starts.
+	"""
+	queue = tm.get_pending_priorities()
+	random.shuffle(queue)
+	for priority in queue:
+		# The task may have been marked as skipped by another target in the meantime:
+		task = tm.get_task(priority=priority)
+		if task:
+			yield task
+
+#------------------------------------------------------------------------------
+def _master(comm, todo_file, overwrite=False, summary=None, shuffle=False):
+	"""
+	Master process handing out tasks to the workers and saving the results.
+	"""
+	logger = logging.getLogger(__name__)
+	status = MPI.Status() # get MPI status object
+
+	try:
+		with TaskManager(todo_file, cleanup=True, overwrite=overwrite, summary=summary) as tm:
+			# Get list of tasks:
+			numtasks = tm.get_number_tasks()
+			tm.logger.info("%d tasks to be run", numtasks)
+
+			# Picking tasks in random order avoids all workers
+			# competing for the same input files at the same time:
+			shuffled_tasks = _shuffled_tasks(tm) if shuffle else None
+
+			# Start the master loop that will assign tasks
+			# to the workers:
+			num_workers = comm.size - 1
+			closed_workers = 0
+			tm.logger.info("Master starting with %d workers", num_workers)
+			while closed_workers < num_workers:
+				# Ask workers for information:
+				data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+				source = status.Get_source()
+				tag = status.Get_tag()
+
+				if tag == tags.DONE:
+					# The worker is done with a task
+					tm.logger.info("Got data from worker %d: %s", source, data)
+					tm.save_result(data)
+
+				if tag in (tags.DONE, tags.READY):
+					# Worker is ready, so send it a task:
+					task = next(shuffled_tasks, None) if shuffle else tm.get_task()
+					if task:
+						task_index = task['priority']
+						tm.start_task(task_index)
+						comm.send(task, dest=source, tag=tags.START)
+						tm.logger.info("Sending task %d to worker %d", task_index, source)
+					else:
+						comm.send(None, dest=source, tag=tags.EXIT)
+
+				elif tag == tags.EXIT:
+					# The worker has exited
+					tm.logger.info("Worker %d exited.", source)
+					closed_workers += 1
+
+				else:
+					# This should never happen, but just to
+					# make sure we don't run into an infinite loop:
+					raise Exception("Master received an unknown tag: '{0}'".format(tag))
+
+			tm.logger.info("Master finishing")
+
+	except:
+		# If something fails in the master, stop all the workers as well:
+		logger.exception("Something failed in master")
+		comm.Abort(1)
+
+#------------------------------------------------------------------------------
+def _worker(comm, **kwargs):
+	"""
+	Worker process running the photometry on the tasks received from the master.
+
+	Only the result dictionary is send back to the master. The lightcurve
+	itself is saved directly by the photometry object.
+	"""
+	logger = logging.getLogger(__name__)
+	status = MPI.Status() # get MPI status object
+
+	try:
+		# Send signal that we are ready for task:
+		comm.send(None, dest=0, tag=tags.READY)
+
+		while True:
+			# Receive a task from the master:
+			task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+			tag = status.Get_tag()
+
+			if tag == tags.START:
+				# Do the work here
+				result = task.copy()
+				del task['priority'], task['tmag']
+
+				t1 = default_timer()
+				pho = tessphot(return_summary=True, **task, **kwargs)
+				t2 = default_timer()
+
+				# Construct result message:
+				result.update({
+					'status': pho.status,
+					'time': t2 - t1,
+					'details': pho._details
+				})
+
+				# Send the result back to the master:
+				comm.send(result, dest=0, tag=tags.DONE)
+
+			elif tag == tags.EXIT:
+				# We were told to EXIT, so lets do that
+				break
+
+			else:
+				# This should never happen, but just to
+				# make sure we don't run into an infinite loop:
+				raise Exception("Worker received an unknown tag: '{0}'".format(tag))
+
+	except:
+		logger.exception("Something failed in worker")
+
+	finally:
+		comm.send(None, dest=0, tag=tags.EXIT)
+
+#------------------------------------------------------------------------------
+def mpi_tessphot(todo_file, input_folder, output_folder, overwrite=False, summary=None, shuffle=False, **kwargs):
+	"""
+	Run the photometry pipeline on all tasks in a TODO-list using MPI.
+
+	Rank 0 acts as the master, handing out tasks from the TODO-list and saving
+	the results, while all other ranks are workers running :py:func:`tessphot`.
+	This function should therefore be called from all MPI processes.
+
+	Parameters:
+		todo_file (string): Path to the TODO-file.
+		input_folder (string): Root directory where input files are loaded from.
+		output_folder (string): Root directory where output files are saved.
+		overwrite (boolean, optional): Overwrite existing results. Default=False.
+		summary (string, optional): Path to JSON file where a summary of the processing will be written.
+		shuffle (boolean, optional): Hand out the tasks in random order, to avoid workers
+			simultaneously competing for access to the same input files. The TODO-list is
+			shuffled once before the first task is handed out. Default is to hand out the
+			tasks in order of priority.
+		**kwargs: Additional keyword-arguments passed on to :py:func:`tessphot` for all tasks.
+
+	.. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
+	"""
+
+	comm = MPI.COMM_WORLD # get MPI communicator object
+
+	if comm.rank == 0:
+		_master(comm, todo_file, overwrite=overwrite, summary=summary, shuffle=shuffle)
+	else:
+		_worker(comm, input_folder=input_folder, output_folder=output_folder, **kwargs)
@@ -7,6 +7,7 @@ Preparation for Photometry extraction.
 """
 
 import os
+import sys
 import numpy as np
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning, module='h5py')
@@ -17,11 +18,20 @@ import logging
 import re
 import multiprocessing
 from astropy.wcs import WCS
-from bottleneck import replace, nanmean, nanmedian
+from bottleneck import replace, nanmedian
+from numba import njit, prange
+try:
+	from multiprocessing.shared_memory import SharedMemory
+	from multiprocessing import resource_tracker
+except ImportError: # pragma: no cover
+	# Only available in Python 3.8+
+	SharedMemory = None
 from timeit import default_timer
 import itertools
 import functools
 import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm, trange
 from .catalog import download_catalogs
 from .backgrounds import fit_background
@@ -53,9 +63,306 @@ def quality_from_tpf(tpffile, time_start, time_end):
 	return quality
 
 #------------------------------------------------------------------------------
-def _iterate_hdf_group(dset, start=0, stop=None):
+@njit(parallel=True, cache=True)
+def _accumulate_sumimage(flux, SumImage, Nimg):
+	"""
+	Add the finite pixels of ``flux`` to ``SumImage`` and count them in ``Nimg``.
+
+	Does in a single pass over the image what would otherwise be done as
+	separate ``isfinite``, ``replace`` and addition passes.
+	"""
+	for i in prange(flux.shape[0]):
+		for j in range(flux.shape[1]):
+			v = flux[i, j]
+			if v == v: # Not NaN
+				SumImage[i, j] += v
+				Nimg[i, j] += 1
+
+#------------------------------------------------------------------------------
+def _iterate_hdf_group(dset, start=0, stop=None, out=None):
+	"""
+	Iterate through the datasets in a HDF5 group.
+
+	If ``out`` is provided, the datasets are read directly into this
+	pre-allocated array, which is yielded every time. Consumers therefore have
+	to copy the array if they need to keep it across iterations.
+	"""
 	for d in range(start, stop if stop is not None else len(dset)):
-		yield np.asarray(dset['%04d' % d])
+		if out is None:
+			yield np.asarray(dset['%04d' % d])
+		else:
+			dset['%04d' % d].read_direct(out)
+			yield out
+
+#------------------------------------------------------------------------------
+def _iterate_hdf_slabs(dset, start=0, stop=None, slab=8, out=None):
+	"""
+	Iterate through the datasets in a HDF5 group in slabs of several images.
+
+	Yields 3D arrays with shape ``(n, rows, cols)``, where ``n`` is at most ``slab``.
+	If ``out`` is provided, it must have shape ``(slab, rows, cols)`` and the
+	datasets are read directly into it, in which case views into ``out`` are
+	yielded and consumers have to copy them if they need to keep them across iterations.
+	"""
+	stop = stop if stop is not None else len(dset)
+	for s in range(start, stop, slab):
+		n = min(slab, stop - s)
+		if out is None:
+			block = np.empty((n,) + dset['%04d' % s].shape, dtype='float32')
+		else:
+			block = out[:n]
+		for i in range(n):
+			dset['%04d' % (s+i)].read_direct(block[i])
+		yield block
+
+#------------------------------------------------------------------------------
+def _pixel_background_shenanigans_slab(slab, SumImage=None):
+	"""Run :py:func:`pixel_background_shenanigans` on every image in a slab of images."""
+	out = np.empty(slab.shape, dtype='float32')
+	for i, img in enumerate(slab):
+		out[i] = pixel_background_shenanigans(img, SumImage=SumImage)
+	return out
+
+#------------------------------------------------------------------------------
+def _require_unsmoothed_backgrounds(hdftmp, numfiles, img_shape, imgchunks, **kwargs):
+	"""
+	Get the 3D dataset of unsmoothed backgrounds in the temporary HDF5 file, creating it if needed.
+
+	The dataset is resized if more files have been added since it was created.
+	Temporary files from earlier versions, storing the backgrounds as a group
+	of 2D datasets, are converted by copying the backgrounds into the new dataset.
+
+	Parameters:
+		hdftmp (:py:class:`h5py.File`): Temporary HDF5 file.
+		numfiles (integer): Number of backgrounds.
+		img_shape (tuple): Shape of the images.
+		imgchunks (tuple): Chunk-size of each image.
+		**kwargs: Additional settings passed on to :py:meth:`h5py.Group.create_dataset`.
+
+	Returns:
+		:py:class:`h5py.Dataset`: Dataset with shape ``(numfiles, rows, cols)``, with the number
+			of backgrounds already stored in it, counted from the start, in the ``completed`` attribute.
+	"""
+	old = None
+	if 'backgrounds_unsmoothed' in hdftmp:
+		if isinstance(hdftmp['backgrounds_unsmoothed'], h5py.Group):
+			hdftmp.move('backgrounds_unsmoothed', 'backgrounds_unsmoothed_old')
+			old = hdftmp['backgrounds_unsmoothed_old']
+		else:
+			dset = hdftmp['backgrounds_unsmoothed']
+			if dset.shape[0] != numfiles:
+				dset.resize(numfiles, axis=0)
+			return dset
+
+	dset = hdftmp.create_dataset('backgrounds_unsmoothed',
+		shape=(numfiles, img_shape[0], img_shape[1]),
+		maxshape=(None, img_shape[0], img_shape[1]),
+		chunks=(1, imgchunks[0], imgchunks[1]),
+		dtype='float32',
+		fillvalue=np.nan,
+		**kwargs
+	)
+
+	completed = 0
+	if old is not None:
+		# Copy the consecutive backgrounds from the start of the old group:
+		while completed < numfiles and '%04d' % completed in old:
+			dset[completed, :, :] = old['%04d' % completed]
+			completed += 1
+		del hdftmp['backgrounds_unsmoothed_old']
+
+	dset.attrs['completed'] = completed
+	return dset
+
+#------------------------------------------------------------------------------
+def _iterate_time_smoothed(dset, w, frames=None):
+	"""
+	Iterate through the backgrounds smoothed in time.
+
+	Each smoothed background is the mean of the finite values of the unsmoothed
+	backgrounds within ``w`` timestamps on either side. A running sum and count
+	of finite values are kept for the sliding window, and the frames in the
+	window are kept in memory, so every unsmoothed background is only read once.
+
+	Parameters:
+		dset (:py:class:`h5py.Dataset`): 3D dataset of unsmoothed backgrounds with shape ``(numfiles, rows, cols)``.
+		w (integer): Number of timestamps on either side to include in the mean.
+		frames (iterable of integers, optional): Increasing indices of the smoothed backgrounds
+			to calculate. Default is to calculate all of them.
+
+	Returns:
+		iterator: Iterator of the index and the smoothed background. The same array is
+			yielded every time, so consumers have to copy it if they need to keep it.
+	"""
+	numfiles = dset.shape[0]
+	img_shape = dset.shape[1:]
+	if frames is None:
+		frames = range(numfiles)
+
+	# Ring-buffers holding the frames in the window, with non-finite values set to zero,
+	# and where they were finite. The window never contains more than 2*w+1 frames:
+	nslots = 2*w + 1
+	slot_frames = np.empty((nslots, img_shape[0], img_shape[1]), dtype='float32')
+	slot_finite = np.empty((nslots, img_shape[0], img_shape[1]), dtype='bool')
+	notfinite = np.empty(img_shape, dtype='bool')
+
+	running_sum = np.zeros(img_shape, dtype='float64')
+	running_cnt = np.zeros(img_shape, dtype='int32')
+	win1 = win2 = 0 # Current window is [win1, win2)
+	bck = np.empty(img_shape, dtype='float32')
+	for k in frames:
+		indx1 = max(k-w, 0)
+		indx2 = min(k+w+1, numfiles)
+
+		# If the new window doesn't overlap the current one
+		# (happens when resuming), simply start over:
+		if indx1 >= win2:
+			running_sum[:, :] = 0
+			running_cnt[:, :] = 0
+			win1 = win2 = indx1
+
+		# Subtract the frames leaving the window. This has to be done
+		# first, since their slots are reused by the frames entering:
+		for i in range(win1, indx1):
+			s = i % nslots
+			running_cnt -= slot_finite[s]
+			running_sum -= slot_frames[s]
+		win1 = indx1
+
+		# Add the frames entering the window:
+		for i in range(win2, indx2):
+			s = i % nslots
+			dset.read_direct(slot_frames[s], np.s_[i, :, :])
+			np.isfinite(slot_frames[s], out=slot_finite[s])
+			np.logical_not(slot_finite[s], out=notfinite)
+			np.copyto(slot_frames[s], 0, where=notfinite)
+			running_cnt += slot_finite[s]
+			running_sum += slot_frames[s]
+		win2 = indx2
+
+		# Mean of the finite values in the window,
+		# which is NaN if there are no finite values:
+		np.divide(running_sum, np.maximum(running_cnt, 1), out=bck, casting='unsafe')
+		bck[running_cnt == 0] = np.nan
+		yield k, bck
+
+#------------------------------------------------------------------------------
+def _prefetch(func, iterable, depth=2):
+	"""
+	Iterate through ``func(item)`` for every item in ``iterable``, while the
+	results for the following items are being evaluated in background threads.
+
+	This is used for hiding I/O latency, since the file reading and decompression
+	is done in C code which releases the GIL.
+	"""
+	with ThreadPoolExecutor(max_workers=depth) as executor:
+		futures = collections.deque()
+		for item in iterable:
+			futures.append(executor.submit(func, item))
+			if len(futures) >= depth:
+				yield futures.popleft().result()
+		while futures:
+			yield futures.popleft().result()
+
+#------------------------------------------------------------------------------
+def _shm_slots(buf, window, shape):
+	"""Background and mask arrays with ``window`` slots in shared memory buffer."""
+	npix = shape[0]*shape[1]
+	bck = np.ndarray((window, shape[0], shape[1]), dtype='float32', buffer=buf)
+	mask = np.ndarray((window, shape[0], shape[1]), dtype='bool', buffer=buf, offset=4*window*npix)
+	return bck, mask
+
+#------------------------------------------------------------------------------
+def _attach_shared_memory(name):
+	"""Attach to shared memory segment created by another process."""
+	# The segment is owned by the parent process. Tracking it in the worker would
+	# unlink it when the worker exits, even while the parent and other workers are
+	# still using it:
+	if sys.version_info >= (3, 13):
+		return SharedMemory(name=name, track=False)
+	shm = SharedMemory(name=name)
+	resource_tracker.unregister(shm._name, 'shared_memory')
+	return shm
+
+#------------------------------------------------------------------------------
+def _shared_memory_available():
+	"""Free space in bytes for shared memory, or None if it is not known."""
+	try:
+		st = os.statvfs('/dev/shm')
+	except (AttributeError, OSError):
+		return None
+	return st.f_bavail * st.f_frsize
+
+#------------------------------------------------------------------------------
+def _fit_background_shm(fname, slot, func=None, shm_name=None, window=None, shape=None):
+	"""
+	Worker estimating background, which writes the result directly
+	into a slot in shared memory instead of returning it.
+	"""
+	bck, mask = func(fname)
+	shm = _attach_shared_memory(shm_name)
+	try:
+		bck_slots, mask_slots = _shm_slots(shm.buf, window, shape)
+		bck_slots[slot] = bck
+		mask_slots[slot] = mask
+		del bck_slots, mask_slots
+	finally:
+		shm.close()
+	return slot
+
+#------------------------------------------------------------------------------
+def _iterate_backgrounds_shm(pool, func, files, shape, window):
+	"""
+	Run background estimation in pool of workers, transferring the results
+	back through shared memory instead of pickling them through pipes.
+
+	At most ``window`` files are being processed at any one time, so each
+	slot in the shared memory is only reused once its result has been copied out.
+	The window is reduced if there is not enough free shared memory (e.g. in
+	Docker containers, which by default only have 64 MB), and if the shared memory
+	can not be used at all, the results are pickled back from the workers instead.
+	"""
+	logger = logging.getLogger(__name__)
+	npix = shape[0]*shape[1]
+
+	# Only use up to half of the free shared memory, since writing beyond
+	# what is available kills the process instead of raising an error:
+	available = _shared_memory_available()
+	if available is not None:
+		window = min(window, available//(2*5*npix))
+
+	shm = None
+	if window < 1:
+		logger.warning("Not enough free shared memory. Falling back to pickling the backgrounds.")
+	else:
+		try:
+			shm = SharedMemory(create=True, size=5*window*npix)
+		except OSError:
+			logger.warning("Could not allocate shared memory. Falling back to pickling the backgrounds.")
+	if shm is None:
+		yield from pool.imap(func, files)
+		return
+
+	bck_slots = mask_slots = None
+	try:
+		bck_slots, mask_slots = _shm_slots(shm.buf, window, shape)
+		worker = functools.partial(_fit_background_shm, func=func, shm_name=shm.name, window=window, shape=shape)
+
+		pending = collections.deque()
+		for k, fname in enumerate(files):
+			# Wait for the oldest result before reusing its slot:
+			if len(pending) >= window:
+				slot = pending.popleft().get()
+				yield bck_slots[slot].copy(), mask_slots[slot].copy()
+			pending.append(pool.apply_async(worker, (fname, k % window)))
+
+		while pending:
+			slot = pending.popleft().get()
+			yield bck_slots[slot].copy(), mask_slots[slot].copy()
+	finally:
+		del bck_slots, mask_slots
+		shm.close()
+		shm.unlink()
 
 #------------------------------------------------------------------------------
 def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
@@ -116,23 +423,24 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 	# If no sectors are provided, find all the available FFI files and figure out
 	# which sectors they are all from:
 	if sectors is None:
-		sectors = []
+		sectors = set()
 
 		# TODO: Could we change this so we don't have to parse the filenames?
+		regex_ffi = re.compile(r'^tess.+-s(\d+)-.+\.fits')
 		for fname in find_ffi_files(input_folder):
-			m = re.match(r'^tess.+-s(\d+)-.+\.fits', os.path.basename(fname))
-			if int(m.group(1)) not in sectors:
-				sectors.append(int(m.group(1)))
+			m = regex_ffi.match(os.path.basename(fname))
+			sectors.add(int(m.group(1)))
 
 		# Also collect sectors from TPFs. They are needed for ensuring that
 		# catalogs are available. Can be added directly to the sectors list,
 		# since the HDF5 creation below will simply skip any sectors with
 		# no FFIs available
+		regex_tpf = re.compile(r'^.+-s(\d+)[-_].+_tp\.fits')
 		for fname in find_tpf_files(input_folder):
-			m = re.match(r'^.+-s(\d+)[-_].+_tp\.fits', os.path.basename(fname))
-			if int(m.group(1)) not in sectors:
-				sectors.append(int(m.group(1)))
+			m = regex_tpf.match(os.path.basename(fname))
+			sectors.add(int(m.group(1)))
 
+		sectors = sorted(sectors)
 		logger.debug("Sectors found: %s", sectors)
 	else:
 		sectors = (sectors,)
@@ -225,9 +533,14 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 				# will hold thing we dont need in the final HDF5 file.
 				tmp_hdf_file = hdf_file.replace('.hdf5', '.tmp.hdf5')
 				with h5py.File(tmp_hdf_file, 'a', libver='latest') as hdftmp:
-					dset_bck_us = hdftmp.require_group('backgrounds_unsmoothed')
-
-					if len(pixel_flags) < numfiles:
+					# The unsmoothed backgrounds are stored in a single 3D dataset,
+					# chunked so each chunk only contains a single timestamp.
+					# The number of backgrounds written so far is kept in the "completed"
+					# attribute, since unwritten backgrounds simply read back as NaN:
+					dset_bck_us = _require_unsmoothed_backgrounds(hdftmp, numfiles, img_shape, imgchunks, **args)
+					completed = int(dset_bck_us.attrs.get('completed', 0))
+
+					if len(pixel_flags) < numfiles or completed < numfiles:
 						logger.info('Calculating backgrounds...')
 
 						# Create wrapper function freezing some of the
@@ -243,17 +556,28 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 
 						tic = default_timer()
 
+						# Start from the first background missing either its pixel flags
+						# or its unsmoothed background, e.g. if the temporary file was lost:
 						last_bck_fit = -1 if len(pixel_flags) == 0 else int(sorted(list(pixel_flags.keys()))[-1])
+						last_bck_fit = min(last_bck_fit, completed-1)
 						k = last_bck_fit+1
-						for bck, mask in tqdm(m(fit_background_wrapper, files[k:]), initial=k, total=numfiles, **tqdm_settings):
+						if threads > 1 and SharedMemory is not None:
+							results = _iterate_backgrounds_shm(pool, fit_background_wrapper, files[k:], img_shape, 2*threads)
+						else:
+							results = m(fit_background_wrapper, files[k:])
+
+						for bck, mask in tqdm(results, initial=k, total=numfiles, **tqdm_settings):
 							dset_name = '%04d' % k
 							logger.debug("Background %d complete", k)
 							logger.debug("Estimate: %f sec/image", (default_timer()-tic)/(k-last_bck_fit))
 
-							dset_bck_us.create_dataset(dset_name, data=bck)
+							dset_bck_us[k, :, :] = bck
+							dset_bck_us.attrs['completed'] = k+1
 
 							# If we ever defined pixel flags above 256, we have to change this to uint16
-							mask = np.asarray(np.where(mask, PixelQualityFlags.NotUsedForBackground, 0), dtype='uint8')
+							# Reinterpreting the boolean mask as 0/1 avoids the temporary int array:
+							mask = np.asarray(mask, dtype='bool').view('uint8') * np.uint8(PixelQualityFlags.NotUsedForBackground)
+							if dset_name in pixel_flags: del pixel_flags[dset_name]
 							pixel_flags.create_dataset(dset_name, data=mask, chunks=imgchunks, **args)
 
 							k += 1
@@ -273,23 +597,13 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 					backgrounds.attrs['radial_smooth'] = radial_smooth
 					w = time_smooth//2
 					tic = default_timer()
-					for k in trange(numfiles, **tqdm_settings):
-						dset_name = '%04d' % k
-						if dset_name in backgrounds: continue
 
-						indx1 = max(k-w, 0)
-						indx2 = min(k+w+1, numfiles)
-						logger.debug("Smoothing background %d: %d -> %d", k, indx1, indx2)
-
-						block = np.empty((img_shape[0], img_shape[1], indx2-indx1), dtype='float32')
-						logger.debug(block.shape)
-						for i, k in enumerate(range(indx1, indx2)):
-							block[:, :, i] = dset_bck_us['%04d' % k]
-
-						bck = nanmean(block, axis=2)
+					frames = [k for k in range(numfiles) if '%04d' % k not in backgrounds]
+					smoothed = _iterate_time_smoothed(dset_bck_us, w, frames=frames)
+					for k, bck in tqdm(smoothed, total=len(frames), **tqdm_settings):
+						logger.debug("Smoothing background %d: %d -> %d", k, max(k-w, 0), min(k+w+1, numfiles))
 						#bck_err = np.sqrt(nansum(block_err**2, axis=2)) / time_smooth
-
-						backgrounds.create_dataset(dset_name, data=bck, chunks=imgchunks, **args)
+						backgrounds.create_dataset('%04d' % k, data=bck, chunks=imgchunks, **args)
 
 					toc = default_timer()
 					logger.info("Background smoothing: %f sec/image", (toc-tic)/numfiles)
@@ -311,6 +625,8 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 				cadenceno = np.empty(numfiles, dtype='int32')
 				quality = np.empty(numfiles, dtype='int32')
 				UsedInBackgrounds = np.zeros_like(SumImage, dtype='int32')
+				pf_buf = np.empty(img_shape, dtype='uint8')
+				used_buf = np.empty(img_shape, dtype='uint8')
 
 				# Save list of file paths to the HDF5 file:
 				filenames = [os.path.basename(fname).rstrip('.gz').encode('ascii', 'strict') for fname in files]
@@ -328,12 +644,19 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 					'CRSPOC': None
 				}
 				logger.info('Final processing of individual images...')
+				flag_manexcl = np.uint8(PixelQualityFlags.ManualExclude)
+				flag_notused = np.uint8(PixelQualityFlags.NotUsedForBackground)
+				check_constant = logger.isEnabledFor(logging.ERROR)
 				tic = default_timer()
-				for k, fname in enumerate(tqdm(files, **tqdm_settings)):
-					dset_name = '%04d' % k
 
-					# Load the FITS file data and the header:
-					flux0, hdr, flux0_err = load_ffi_fits(fname, return_header=True, return_uncert=True)
+				# Load the FITS file data and the headers,
+				# reading the next file while the current one is being processed:
+				load_ffi_wrapper = functools.partial(load_ffi_fits, return_header=True, return_uncert=True)
+				ffis = _prefetch(load_ffi_wrapper, files)
+
+				for k, (flux0, hdr, flux0_err) in enumerate(tqdm(ffis, total=numfiles, **tqdm_settings)):
+					dset_name = '%04d' % k
+					pf_dset = pixel_flags[dset_name]
 
 					# Check if this is real TESS data:
 					# Could proberly be done more elegant, but if it works, it works...
@@ -369,11 +692,14 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 					# Data quality flags:
 					quality[k] = hdr.get('DQUALITY', 0)
 
+					# Check that the attributes are constant for all images,
+					# which is only done if the error would actually be logged:
 					if k == 0:
 						for key in attributes.keys():
 							attributes[key] = hdr.get(key)
-					else:
-						for key, value in attributes.items():
+						check_attrs = tuple(attributes.items())
+					elif check_constant:
+						for key, value in check_attrs:
 							if hdr.get(key) != value:
 								logger.error("%s is not constant!", key)
 
@@ -382,7 +708,7 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 
 					# Add manual excludes to pixel flags:
 					if np.any(manexcl):
-						pixel_flags[dset_name][manexcl] |= PixelQualityFlags.ManualExclude
+						pf_dset[manexcl] |= flag_manexcl
 
 					if dset_name not in images:
 						# Mask out manually excluded data before saving:
@@ -408,12 +734,14 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 
 					# Add together images for sum-image:
 					if TESSQualityFlags.filter(quality[k]):
-						Nimg += np.isfinite(flux0)
-						replace(flux0, np.nan, 0)
-						SumImage += flux0
+						_accumulate_sumimage(flux0, SumImage, Nimg)
 
 					# Add together the number of times each pixel was used in the background estimation:
-					UsedInBackgrounds += (np.asarray(pixel_flags[dset_name]) & PixelQualityFlags.NotUsedForBackground == 0)
+					# This is done with preallocated buffers to avoid temporary arrays:
+					pf_dset.read_direct(pf_buf)
+					np.bitwise_and(pf_buf, flag_notused, out=used_buf)
+					np.equal(used_buf, 0, out=used_buf)
+					np.add(UsedInBackgrounds, used_buf, out=UsedInBackgrounds)
 
 				# Normalize sumimage
 				SumImage /= Nimg
@@ -473,7 +801,7 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 				bkgshe_threshold = pixel_flags.attrs.get('bkgshe_threshold', 40)
 				pixel_flags.attrs['bkgshe_threshold'] = bkgshe_threshold
 				pixel_background_shenanigans_wrapper = functools.partial(
-					pixel_background_shenanigans,
+					_pixel_background_shenanigans_slab,
 					SumImage=SumImage
 				)
 
@@ -492,11 +820,18 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 					if last_bkgshe < numfiles-1:
 						tic = default_timer()
 						k = last_bkgshe + 1
-						for bckshe in tqdm(m(pixel_background_shenanigans_wrapper, _iterate_hdf_group(images, start=k)), initial=k, total=numfiles, **tqdm_settings):
-							pixel_flags_ind[:, :, k] = bckshe
-							pixel_flags_ind.attrs['bkgshe_done'] = k
-							k += 1
-							hdftmp.flush()
+						# The images are send to the workers in slabs of several
+						# images, to cut down on the number of round-trips:
+						slab = 8
+						buf = np.empty((slab, img_shape[0], img_shape[1]), dtype='float32')
+						with tqdm(initial=k, total=numfiles, **tqdm_settings) as pbar:
+							for bckshe in m(pixel_background_shenanigans_wrapper, _iterate_hdf_slabs(images, start=k, slab=slab, out=buf)):
+								n = bckshe.shape[0]
+								pixel_flags_ind[:, :, k:k+n] = np.moveaxis(bckshe, 0, 2)
+								k += n
+								pixel_flags_ind.attrs['bkgshe_done'] = k-1
+								hdftmp.flush()
+								pbar.update(n)
 						logger.info("Background Shenanigans: %f sec/image", (default_timer()-tic)/(numfiles-last_bkgshe))
 
 					# Calculate the mean Background Shenanigans indicator:
@@ -536,6 +871,7 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 					#fig.savefig('test.png', bbox_inches='tight')
 
 					logger.info("Setting background shenanigans...")
+					flag_bkgshe = np.uint8(PixelQualityFlags.BackgroundShenanigans)
 					tic = default_timer()
 					for k in trange(numfiles, **tqdm_settings):
 						dset_name = '%04d' % k
@@ -555,14 +891,14 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 						# (both positive and negative) in the image:
 						bckshe = np.abs(bckshe - mean_shenanigans) > bkgshe_threshold
 
-						# Clear any old flags:
-						indx = (np.asarray(pixel_flags[dset_name]) & PixelQualityFlags.BackgroundShenanigans != 0)
-						if np.any(indx):
-							pixel_flags[dset_name][indx] -= PixelQualityFlags.BackgroundShenanigans
+						# Clear any old flags and set the new ones:
+						pf_dset = pixel_flags[dset_name]
+						pf = np.asarray(pf_dset)
+						pf_new = (pf & ~flag_bkgshe) | (bckshe.view('uint8') * flag_bkgshe)
 
 						# Save the new flags to the permanent HDF5 file:
-						if np.any(bckshe):
-							pixel_flags[dset_name][bckshe] |= PixelQualityFlags.BackgroundShenanigans
+						if np.any(pf_new != pf):
+							pf_dset[:, :] = pf_new
 
 						pixel_flags.attrs['bkgshe_done'] = k
 						hdf.flush()
@@ -600,7 +936,8 @@ def prepare_photometry(input_folder=None, sectors=None, cameras=None, ccds=None,
 
 				tic = default_timer()
 
-				datasets = _iterate_hdf_group(images)
+				buf = np.empty(img_shape, dtype='float32')
+				datasets = _iterate_hdf_group(images, out=buf)
 				for k, knl in enumerate(tqdm(m(imk.calc_kernel, datasets), **tqdm_settings)):
 					kernel[k, :] = knl
 					logger.debug("Kernel: %s", knl)
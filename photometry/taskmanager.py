@@ -160,16 +160,22 @@ class TaskManager(object):
 		num = int(self.cursor.fetchone()['num'])
 		return num
 
-	def get_task(self, starid=None):
+	def get_task(self, starid=None, priority=None):
 		"""
 		Get next task to be processed.
 
+		Parameters:
+			starid (integer, optional): Only return a task for this star.
+			priority (integer, optional): Only return the task with this priority.
+
 		Returns:
 			dict or None: Dictionary of settings for task.
 		"""
 		constraints = []
 		if starid is not None:
 			constraints.append("starid=%d" % starid)
+		if priority is not None:
+			constraints.append("priority=%d" % priority)
 
 		if constraints:
 			constraints = " AND " + " AND ".join(constraints)
@@ -181,6 +187,16 @@ class TaskManager(object):
 		if task: return dict(task)
 		return None
 
+	def get_pending_priorities(self):
+		"""
+		Get the priorities of all tasks due to be processed.
+
+		Returns:
+			list: Priorities of the tasks due to be processed, in priority order.
+		"""
+		self.cursor.execute("SELECT priority FROM todolist WHERE status IS NULL ORDER BY priority;")
+		return [row['priority'] for row in self.cursor.fetchall()]
+
 	def get_random_task(self):
 		"""
 		Get random task to be processed.
@@ -4,47 +4,341 @@
 .. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
 """
 
+import os
+import atexit
 import logging
+import sqlite3
+import pickle
+import threading
 import traceback
-from . import STATUS, AperturePhotometry, PSFPhotometry, LinPSFPhotometry, HaloPhotometry
+import multiprocessing
+import functools
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from timeit import default_timer
+from . import BasePhotometry, STATUS, AperturePhotometry, PSFPhotometry, LinPSFPhotometry, HaloPhotometry
+from .utilities import find_hdf5_files, find_tpf_files
+
+#------------------------------------------------------------------------------
+class _OncePerStar(logging.Filter):
+	"""
+	Logging filter only letting the same message through once for each star.
+
+	Only applied to records logged with a ``starid`` in ``extra``. Only the
+	``maxsize`` most recently logged stars are remembered, so the memory used
+	stays bounded in long batch runs.
+	"""
+	def __init__(self, name='', maxsize=1024):
+		super(_OncePerStar, self).__init__(name)
+		self.maxsize = maxsize
+		self.seen = OrderedDict()
+
+	def filter(self, record):
+		starid = getattr(record, 'starid', None)
+		if starid is None:
+			return True
+		msgs = self.seen.get(starid)
+		if msgs is None:
+			msgs = self.seen[starid] = set()
+			if len(self.seen) > self.maxsize:
+				self.seen.popitem(last=False)
+		else:
+			self.seen.move_to_end(starid)
+		if record.msg in msgs:
+			return False
+		msgs.add(record.msg)
+		return True
+
+	def forget(self, starid):
+		"""Let messages for the given star through again."""
+		self.seen.pop(starid, None)
+
+logger = logging.getLogger(__name__)
+_once_per_star = _OncePerStar()
+logger.addFilter(_once_per_star)
+
+# Photometry classes to use for the different methods:
+_METHODS = {
+	None: AperturePhotometry,
+	'aperture': AperturePhotometry,
+	'psf': PSFPhotometry,
+	'linpsf': LinPSFPhotometry,
+	'halo': HaloPhotometry
+}
+
+# Limits used by the dynamical scheme (method=None) to decide if aperture photometry
+# with a warning should be followed by another method. Stars with a contamination
+# above the threshold are tried with PSF photometry, and stars brighter than the
+# magnitude limit, which will be heavily saturated, are tried with halo photometry:
+_CROWDING_THRESHOLD = 0.5
+_HALO_TMAG_LIMIT = 6.8
+
+# Statuses where the lightcurve should be saved:
+_OK_STATES = frozenset((STATUS.OK, STATUS.WARNING))
+
+# Exceptions which should abort the photometry, not mark it as failed:
+_ABORT_EXCEPTIONS = (KeyboardInterrupt, SystemExit)
+
+# Tracebacks from photometry classes that failed already in their constructor,
+# keyed on the class and arguments, so the same failure is not retried.
+# Only errors caused by the arguments themselves, which will fail the same way
+# every time, are stored. Errors like OSError or MemoryError may be transient:
+_dead_configs = OrderedDict()
+_DEAD_CONFIGS_MAXSIZE = 1024
+_DEAD_CONFIG_ERRORS = (ValueError, TypeError)
+
+# Thread pool used for writing lightcurves in the background.
+# Created when first needed, and never inherited by forked processes:
+_io_pool = None
 
 #------------------------------------------------------------------------------
 class _PhotErrorDummy(object):
-	def __init__(self, traceback, *args, **kwargs):
+	__slots__ = ('status', '_details')
+
+	def __init__(self, tb=None):
 		self.status = STATUS.ERROR
-		self._details = {'errors': traceback} if traceback else {}
+		self._details = {'errors': tb} if tb else {}
 
 #------------------------------------------------------------------------------
-def _try_photometry(PhotClass, *args, **kwargs):
-	logger = logging.getLogger(__name__)
-	tbcollect = []
+def _config_key(PhotClass, args, kwargs):
+	"""Hashable key of photometry class and arguments, or None if arguments are not hashable."""
+	key = (PhotClass, args, tuple(sorted(kwargs.items())))
 	try:
-		with PhotClass(*args, **kwargs) as pho:
-			pho.photometry()
+		hash(key)
+	except TypeError:
+		return None
+	return key
+
+#------------------------------------------------------------------------------
+def _get_io_pool():
+	global _io_pool
+	if _io_pool is None:
+		_io_pool = ThreadPoolExecutor(max_workers=2)
+		atexit.register(_io_pool.shutdown, wait=True)
+	return _io_pool
+
+def _reset_io_pool():
+	global _io_pool
+	_io_pool = None
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_reset_io_pool)
+
+#------------------------------------------------------------------------------
+class PhotResult(namedtuple('PhotResult', 'status starid path details')):
+	"""
+	Lightweight summary of a run of the photometry.
+
+	Attributes:
+		status (:py:class:`STATUS`): Final status of the photometry.
+		starid (int): TIC number of the star.
+		path (string): Path of the saved lightcurve, relative to the output folder, or None if it was not saved.
+		details (dict): Details reported by the photometry.
+	"""
+	__slots__ = ()
+
+	@property
+	def _details(self):
+		# Allows the summary to be used in place of the photometry object:
+		return self.details
+
+	@classmethod
+	def from_photometry(cls, pho):
+		details = pho._details
+		return cls(pho.status, getattr(pho, 'starid', None), details.get('filepath_lightcurve'), details)
+
+#------------------------------------------------------------------------------
+# Cache of finished results, which is only used if the environment variable
+# TESSPHOT_CACHE points to an SQLite file. Opened when first needed:
+_cache_db = None
+_cache_lock = threading.Lock()
+
+def _get_cache_db():
+	global _cache_db
+	if _cache_db is None:
+		db = sqlite3.connect(os.environ['TESSPHOT_CACHE'], timeout=30, check_same_thread=False)
+		db.execute("""CREATE TABLE IF NOT EXISTS results (
+			starid INTEGER NOT NULL,
+			method TEXT NOT NULL,
+			datasource TEXT NOT NULL,
+			sector INTEGER NOT NULL,
+			output_folder TEXT NOT NULL,
+			version INTEGER NOT NULL,
+			plot INTEGER NOT NULL,
+			input_mtime REAL NOT NULL,
+			status INTEGER NOT NULL,
+			details BLOB,
+			PRIMARY KEY (starid, method, datasource, sector, output_folder, version, plot)
+		);""")
+		db.commit()
+		_cache_db = db
+	return _cache_db
+
+def _reset_cache_db():
+	# The connection and the lock may be in use by another thread when forking,
+	# so the child gets its own of both:
+	global _cache_db, _cache_lock
+	_cache_db = None
+	_cache_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_reset_cache_db)
+
+def _input_mtime(starid, input_folder, datasource='ffi', sector=None, camera=None, ccd=None, **kwargs):
+	"""Modification time of the input file used for a star, or None if it could not be found."""
+	if datasource == 'ffi':
+		files = find_hdf5_files(input_folder, sector=sector, camera=camera, ccd=ccd)
+	else:
+		starid_to_load = int(datasource[4:]) if datasource.startswith('tpf:') else starid
+		files = find_tpf_files(input_folder, sector=sector, starid=starid_to_load)
+	if len(files) != 1:
+		return None
+	return os.path.getmtime(files[0])
 
-			if pho.status in (STATUS.OK, STATUS.WARNING):
-				pho.save_lightcurve()
+def _cache_key(method, kwargs):
+	"""Key of task in the result cache, or None if it can not be cached."""
+	if 'TESSPHOT_CACHE' not in os.environ:
+		return None
+	if 'starid' not in kwargs or 'input_folder' not in kwargs or 'output_folder' not in kwargs:
+		return None
+	if kwargs.get('sector') is None:
+		return None
+	version = kwargs.get('version')
+	return (
+		int(kwargs['starid']),
+		method or '',
+		kwargs.get('datasource', 'ffi'),
+		int(kwargs['sector']),
+		os.path.abspath(kwargs['output_folder']),
+		-1 if version is None else int(version),
+		int(bool(kwargs.get('plot', False)))
+	)
 
-	except (KeyboardInterrupt, SystemExit):
+def _lightcurve_exists(details, input_folder, output_folder):
+	"""Check if the lightcurve stored in the details still exists."""
+	path = details.get('filepath_lightcurve')
+	if path is None:
+		return False
+	# The path is either relative to the output folder or, if the output
+	# folder is inside the input folder, relative to the input folder:
+	return any(os.path.isfile(os.path.join(folder, path)) for folder in (output_folder, input_folder))
+
+def _cache_lookup(key, mtime, input_folder):
+	try:
+		with _cache_lock:
+			row = _get_cache_db().execute("""SELECT status,details FROM results WHERE
+				starid=? AND method=? AND datasource=? AND sector=? AND output_folder=? AND version=? AND plot=? AND input_mtime=?;""", key + (mtime,)).fetchone()
+	except sqlite3.OperationalError:
+		logger.exception("Could not read from result cache")
+		return None
+	if row is None:
+		return None
+
+	# Only use the cached result if the lightcurve is still there:
+	details = pickle.loads(row[1])
+	if not _lightcurve_exists(details, input_folder, key[4]):
+		return None
+	return PhotResult(STATUS(row[0]), key[0], details.get('filepath_lightcurve'), details)
+
+def _cache_store(key, mtime, pho):
+	# Failing to update the cache only means that the star will be rerun
+	# next time, so it should not stop the processing:
+	try:
+		with _cache_lock:
+			db = _get_cache_db()
+			db.execute("""INSERT OR REPLACE INTO results
+				(starid,method,datasource,sector,output_folder,version,plot,input_mtime,status,details)
+				VALUES (?,?,?,?,?,?,?,?,?,?);""", key + (mtime, pho.status.value, pickle.dumps(pho._details)))
+			db.commit()
+	except sqlite3.OperationalError:
+		logger.exception("Could not write to result cache")
+
+def _completed(pho):
+	future = Future()
+	future.set_result(pho)
+	return future
+
+#------------------------------------------------------------------------------
+def _save(pho):
+	"""Save the lightcurve, if the photometry went well."""
+	try:
+		if pho.status in _OK_STATES:
+			pho.save_lightcurve()
+
+	except _ABORT_EXCEPTIONS:
 		logger.info("Stopped by user or system")
-		try:
+		pho._status = STATUS.ABORT
+
+	except Exception:
+		if logger.isEnabledFor(logging.ERROR):
+			logger.exception("Something happened")
+		pho._status = STATUS.ERROR
+		pho.report_details(error=traceback.format_exc().strip())
+
+	return pho
+
+def _save_and_close(pho):
+	"""Save the lightcurve, if the photometry went well, and close the photometry object."""
+	try:
+		return _save(pho)
+	finally:
+		pho.close()
+
+#------------------------------------------------------------------------------
+def _try_photometry(PhotClass, *args, save_async=False, force=False, **kwargs):
+	"""
+	Run photometry on a single star, catching any errors.
+
+	If ``save_async=True``, the lightcurve is saved in a background thread and a
+	:py:class:`concurrent.futures.Future` returning the photometry object is returned instead.
+	The status of the photometry is only final once the future has completed.
+	If ``force=True``, the photometry is tried even if the constructor failed before.
+	"""
+	key = _config_key(PhotClass, args, kwargs)
+	if key is not None and not force and key in _dead_configs:
+		logger.debug("Skipping %s which is known to fail", PhotClass.__name__)
+		pho = _PhotErrorDummy(_dead_configs[key])
+		return _completed(pho) if save_async else pho
+
+	pho = None
+	tbcollect = []
+	try:
+		pho = PhotClass(*args, **kwargs)
+		if key is not None:
+			_dead_configs.pop(key, None)
+		pho.photometry()
+
+	except _ABORT_EXCEPTIONS:
+		logger.info("Stopped by user or system")
+		if pho is not None:
 			pho._status = STATUS.ABORT
-		except:
-			pass
 
-	except:
-		logger.exception("Something happened")
+	except Exception as e:
+		if logger.isEnabledFor(logging.ERROR):
+			logger.exception("Something happened")
 		tb = traceback.format_exc().strip()
-		try:
+		if pho is not None:
 			pho._status = STATUS.ERROR
 			pho.report_details(error=tb)
-		except:
+		else:
 			tbcollect.append(tb)
 
-	try:
-		return pho
-	except UnboundLocalError:
-		return _PhotErrorDummy(tbcollect, *args, **kwargs)
+		# The constructor failed because of its arguments, so there is no reason to try it again:
+		if pho is None and key is not None and isinstance(e, _DEAD_CONFIG_ERRORS):
+			_dead_configs[key] = tbcollect
+			if len(_dead_configs) > _DEAD_CONFIGS_MAXSIZE:
+				_dead_configs.popitem(last=False)
+
+	if pho is None:
+		pho = _PhotErrorDummy(tbcollect)
+		return _completed(pho) if save_async else pho
+
+	if save_async:
+		return _get_io_pool().submit(_save_and_close, pho)
+	return _save_and_close(pho)
+
+# _try_photometry bound to the photometry class of each method:
+_RUNNERS = {method: functools.partial(_try_photometry, PhotClass) for method, PhotClass in _METHODS.items()}
 
 #------------------------------------------------------------------------------
 def tessphot(method=None, *args, **kwargs):
@@ -55,39 +349,291 @@ def tessphot(method=None, *args, **kwargs):
 	scheme of trying simple aperture photometry, evaluating its performance
 	and if nessacery try another algorithm.
 
+	In the dynamical scheme (``method=None``), aperture photometry ending with a warning
+	is followed by halo photometry for very bright stars, or by PSF photometry
+	for very crowded stars. The result of the other algorithm is returned if it succeeded.
+
 	Parameters:
 		method (string or None): Type of photometry to run. Can be ``'aperture'``, ``'halo'``, ``'psf'``, ``'linpsf'`` or ``None``.
 		*args: Arguments passed on to the photometry class init-function.
+		force (boolean, optional): Run the photometry even if there is a cached result,
+			or if the photometry class failed for the same arguments before. Default=False.
+		return_summary (boolean, optional): Return a lightweight :py:class:`PhotResult`
+			instead of the photometry object. Default=False.
 		**kwargs: Keyword-arguments passed on to the photometry class init-function.
 
 	Returns:
-		:py:class:`photometry.BasePhotometry`: Photometry object that inherits from :py:class:`photometry.BasePhotometry`.
+		:py:class:`photometry.BasePhotometry`: Photometry object that inherits from :py:class:`photometry.BasePhotometry`,
+			or :py:class:`PhotResult` if ``return_summary=True``.
+
+	Note:
+		If the environment variable ``TESSPHOT_CACHE`` is set to the path of an SQLite file,
+		the status and details of successful runs are stored in it. Running the same
+		star again with ``return_summary=True``, the same settings, unchanged input files
+		and with the lightcurve still in the output folder, then returns the stored result
+		without running the photometry again. The photometry object can not be restored
+		from the cache, so it is always run when ``return_summary=False``.
 	"""
 
-	logger = logging.getLogger(__name__)
+	force = kwargs.pop('force', False)
+	return_summary = kwargs.pop('return_summary', False)
+	if force:
+		_once_per_star.forget(kwargs.get('starid'))
 
-	if method is None:
-		pho = _try_photometry(AperturePhotometry, *args, **kwargs)
+	run = _RUNNERS.get(method)
+	if run is None:
+		raise ValueError("Invalid method: '{0}'".format(method))
 
-		if pho.status == STATUS.WARNING:
-			logger.warning("Try something else?")
-			# TODO: If too crowded:
-			# pho = _try_photometry(PSFPhotometry, starid, input_folder, output_folder, datasource, plot)
+	# Check if this star was already done with the same input data:
+	key = None if args else _cache_key(method, kwargs)
+	if key is not None:
+		mtime = _input_mtime(**kwargs)
+		if mtime is None:
+			key = None
+		elif return_summary and not force:
+			pho = _cache_lookup(key, mtime, kwargs['input_folder'])
+			if pho is not None:
+				logger.info("Using cached result")
+				return pho
 
-	elif method == 'aperture':
-		pho = _try_photometry(AperturePhotometry, *args, **kwargs)
+	pho = run(*args, force=force, **kwargs)
 
-	elif method == 'psf':
-		pho = _try_photometry(PSFPhotometry, *args, **kwargs)
+	if method is None and pho.status == STATUS.WARNING:
+		if getattr(pho, 'target_tmag', float('inf')) < _HALO_TMAG_LIMIT:
+			FallbackClass = HaloPhotometry
+		elif pho._details.get('contamination', 0) > _CROWDING_THRESHOLD:
+			FallbackClass = PSFPhotometry
+		else:
+			FallbackClass = None
 
-	elif method == 'linpsf':
-		pho = _try_photometry(LinPSFPhotometry, *args, **kwargs)
+		if FallbackClass is None:
+			if logger.isEnabledFor(logging.WARNING):
+				starid = getattr(pho, 'starid', None)
+				logger.warning("Star %s: Aperture photometry gave a warning. Try something else?", starid, extra={'starid': starid})
+		else:
+			logger.info("Aperture photometry gave a warning. Trying %s.", FallbackClass.__name__)
+			pho_fallback = _try_photometry(FallbackClass, *args, force=force, **kwargs)
 
-	elif method == 'halo':
-		pho = _try_photometry(HaloPhotometry, *args, **kwargs)
+			# The fallback has overwritten the lightcurve if it went well,
+			# otherwise the one from the aperture photometry is kept:
+			if pho_fallback.status in _OK_STATES:
+				pho = pho_fallback
 
-	else:
-		raise ValueError("Invalid method: '{0}'".format(method))
+	if key is not None and pho.status in _OK_STATES:
+		_cache_store(key, mtime, pho)
 
-	logger.info("Done")
+	if logger.isEnabledFor(logging.INFO):
+		logger.info("Done")
+	if return_summary and not isinstance(pho, PhotResult):
+		return PhotResult.from_photometry(pho)
 	return pho
+
+#------------------------------------------------------------------------------
+def tessphot_batch(starids, method='aperture', **kwargs):
+	"""
+	Run the photometry pipeline on several stars in the same process.
+
+	The stars should all be on the same camera and CCD. The basic data of the
+	CCD (headers, timestamps, sum-image etc.) is read into the shared cache by
+	the first star, and is then reused by all the following stars.
+	The lightcurve of each star is saved in the background while the
+	next star is being processed.
+
+	Parameters:
+		starids (iterable of ints): TIC numbers of the stars to process.
+		method (string, optional): Type of photometry to run. Can be ``'aperture'``, ``'halo'``, ``'psf'`` or ``'linpsf'``. Default is ``'aperture'``.
+		**kwargs: Keyword-arguments passed on to the photometry class init-function for all stars.
+			These should not include ``starid``.
+
+	Returns:
+		iterator: Iterator of photometry objects, one for each star, in the same order as ``starids``.
+
+	Raises:
+		ValueError: If an invalid method is given.
+	"""
+
+	# Checked here, and not in the generator, so invalid input is reported right away:
+	run = _RUNNERS.get(method)
+	if method is None or run is None:
+		raise ValueError("Invalid method: '{0}'".format(method))
+
+	return _iterate_batch(run, starids, **kwargs)
+
+def _iterate_batch(run, starids, **kwargs):
+	# The lightcurve of each star is saved in the background
+	# while the photometry is running on the next star:
+	previous = None
+	for starid in starids:
+		future = run(starid, save_async=True, **kwargs)
+		if previous is not None:
+			yield previous.result()
+		previous = future
+
+	if previous is not None:
+		yield previous.result()
+
+#------------------------------------------------------------------------------
+def tessphot_chunk(tasks, **kwargs):
+	"""
+	Run the photometry pipeline on many stars, grouped by the input files they need.
+
+	The tasks are grouped by method, datasource, sector, camera and CCD, and each
+	group is run with :py:func:`tessphot_batch`, so that the basic data of each CCD
+	in the shared cache is only read once for all the stars on it.
+	The cache is cleared between groups.
+
+	Parameters:
+		tasks (iterable of dicts): Tasks to run. Each task is a dictionary of keyword-arguments
+			passed on to :py:func:`tessphot`, e.g. as returned by :py:func:`TaskManager.get_task`.
+		**kwargs: Keyword-arguments passed on to the photometry class init-function for all tasks.
+
+	Returns:
+		iterator: Iterator of result dictionaries, which are the tasks with
+			``status``, ``time`` and ``details`` added. These can be passed directly
+			to :py:func:`TaskManager.save_result`. Since the stars in a group are
+			processed overlapping each other, ``time`` is the time since the previous
+			result in the group was finished.
+	"""
+
+	groups = OrderedDict()
+	for task in tasks:
+		group = (task.get('method'), task.get('datasource', 'ffi'), task.get('sector'), task.get('camera'), task.get('ccd'))
+		groups.setdefault(group, []).append(task)
+
+	for (method, datasource, sector, camera, ccd), group_tasks in groups.items():
+		group_kwargs = dict(kwargs, datasource=datasource, sector=sector, camera=camera, ccd=ccd)
+		starids = [task['starid'] for task in group_tasks]
+
+		if method is None:
+			# The dynamical scheme may run several methods per star:
+			phos = (tessphot(starid=starid, **group_kwargs) for starid in starids)
+		else:
+			phos = tessphot_batch(starids, method=method, **group_kwargs)
+
+		t1 = default_timer()
+		for task, pho in zip(group_tasks, phos):
+			t2 = default_timer()
+			result = task.copy()
+			result.update({
+				'status': pho.status,
+				'time': t2 - t1,
+				'details': pho._details
+			})
+			t1 = t2
+			yield result
+
+		# Free the images of this CCD before moving on to the next. This is done
+		# even if the last star failed, since earlier stars may have filled the cache:
+		BasePhotometry.clear_cache()
+
+#------------------------------------------------------------------------------
+def _tessphot_worker(task, **kwargs):
+	"""
+	Worker running :py:func:`tessphot` on a single task.
+
+	Only the result dictionary is returned, so the photometry
+	object itself never has to be send between processes.
+	"""
+	result = task.copy()
+	task = {key: value for key, value in task.items() if key not in ('priority', 'tmag')}
+	task.update(kwargs)
+
+	t1 = default_timer()
+	pho = tessphot(return_summary=True, **task)
+	t2 = default_timer()
+
+	# Construct result message:
+	result.update({
+		'status': pho.status,
+		'time': t2 - t1,
+		'details': pho._details
+	})
+	return result
+
+#------------------------------------------------------------------------------
+def tessphot_many(tasks, nprocs=None, **kwargs):
+	"""
+	Run the photometry pipeline on many stars in parallel.
+
+	The tasks are distributed to a pool of worker processes, and the results
+	are yielded as soon as they are finished, which is not necessarily in
+	the same order as the tasks were given.
+
+	Parameters:
+		tasks (iterable of dicts): Tasks to run. Each task is a dictionary of keyword-arguments
+			passed on to :py:func:`tessphot`, e.g. as returned by :py:func:`TaskManager.get_task`.
+		nprocs (integer, optional): Number of processes to use. Default is to use all available CPUs.
+		**kwargs: Keyword-arguments passed on to :py:func:`tessphot` for all tasks.
+
+	Returns:
+		iterator: Iterator of result dictionaries, which are the tasks with
+			``status``, ``time`` and ``details`` added. These can be passed directly
+			to :py:func:`TaskManager.save_result`.
+	"""
+
+	tasks = list(tasks)
+	if nprocs is None:
+		nprocs = int(os.environ.get('SLURM_CPUS_PER_TASK', multiprocessing.cpu_count()))
+
+	worker = functools.partial(_tessphot_worker, **kwargs)
+
+	if nprocs <= 1:
+		for result in map(worker, tasks):
+			yield result
+		return
+
+	chunksize = max(1, len(tasks)//(4*nprocs))
+	with multiprocessing.Pool(nprocs) as pool:
+		for result in pool.imap_unordered(worker, tasks, chunksize=chunksize):
+			yield result
+
+#------------------------------------------------------------------------------
+def dask_tessphot(tasks, client=None, resources=None, **kwargs):
+	"""
+	Run the photometry pipeline on many stars using a Dask cluster.
+
+	Each task is submitted as a separate job, which lets the Dask scheduler
+	balance the load across the workers even though the run-time of the
+	photometry varies a lot from star to star. The results are yielded as
+	soon as they are finished.
+
+	Parameters:
+		tasks (iterable of dicts): Tasks to run. Each task is a dictionary of keyword-arguments
+			passed on to :py:func:`tessphot`, e.g. as returned by :py:func:`TaskManager.get_task`.
+		client (:py:class:`dask.distributed.Client`, optional): Client connected to the cluster
+			to use. If not provided, a local cluster will be started.
+		resources (dict, optional): Abstract resources required by each task, e.g. ``{'mem': 4e9}``,
+			which are passed on to :py:meth:`dask.distributed.Client.submit`.
+		**kwargs: Keyword-arguments passed on to :py:func:`tessphot` for all tasks.
+
+	Returns:
+		iterator: Iterator of result dictionaries, which are the tasks with
+			``status``, ``time`` and ``details`` added. These can be passed directly
+			to :py:func:`TaskManager.save_result`.
+
+	Raises:
+		ImportError: If ``dask.distributed`` is not installed.
+	"""
+
+	# Only imported here, so importing the package does not load dask:
+	try:
+		from dask.distributed import Client, as_completed
+	except ImportError:
+		raise ImportError("dask_tessphot requires dask.distributed to be installed")
+
+	own_client = client is None
+	if own_client:
+		client = Client()
+
+	# The keyword-arguments are bound to the worker function, so they
+	# can not collide with the keywords of Client.submit itself:
+	worker = functools.partial(_tessphot_worker, **kwargs)
+
+	try:
+		futures = [client.submit(worker, task, pure=False, resources=resources) for task in tasks]
+		for future in as_completed(futures):
+			yield future.result()
+			future.release()
+	finally:
+		if own_client:
+			client.close()
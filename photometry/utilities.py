@@ -16,8 +16,9 @@ from scipy.special import erf
 from scipy.stats import binned_statistic
 import json
 import os.path
+import time
 import fnmatch
-import glob
+import functools
 import itertools
 import warnings
 import requests
@@ -39,6 +40,51 @@ def load_settings(sector=None):
 
 	return settings
 
+#------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=1024)
+def _list_folder_cached(path, mtime):
+	dirnames = []
+	filenames = []
+	with os.scandir(path) as it:
+		for entry in it:
+			if entry.is_dir():
+				dirnames.append(entry.name)
+			else:
+				filenames.append(entry.name)
+	return tuple(sorted(dirnames)), tuple(sorted(filenames))
+
+def _list_folder(path):
+	"""
+	List the sub-directories and files in a directory.
+
+	The listing is cached for as long as the modification time of the directory
+	is unchanged, so repeated searches for input files of different stars do
+	not have to read the same directories over and over. Directories modified
+	within the last couple of seconds are not cached, since the modification
+	time only has a limited resolution, and files added right after the listing
+	might not change it.
+
+	Parameters:
+		path (string): Directory to list.
+
+	Returns:
+		tuple: Sorted tuples of the names of sub-directories and of files in the directory.
+	"""
+	mtime = os.stat(path).st_mtime_ns
+	if time.time_ns() - mtime < 2000000000:
+		return _list_folder_cached.__wrapped__(path, mtime)
+	return _list_folder_cached(os.path.abspath(path), mtime)
+
+def _walk(rootdir):
+	"""Cached version of ``os.walk(rootdir, followlinks=True)``."""
+	try:
+		dirnames, filenames = _list_folder(rootdir)
+	except OSError:
+		return
+	yield rootdir, dirnames, filenames
+	for dirname in dirnames:
+		yield from _walk(os.path.join(rootdir, dirname))
+
 #------------------------------------------------------------------------------
 def find_ffi_files(rootdir, sector=None, camera=None, ccd=None):
 	"""
@@ -70,7 +116,7 @@ def find_ffi_files(rootdir, sector=None, camera=None, ccd=None):
 
 	# Do a recursive search in the directory, finding all files that match the pattern:
 	matches = []
-	for root, dirnames, filenames in os.walk(rootdir, followlinks=True):
+	for root, dirnames, filenames in _walk(rootdir):
 		for filename in fnmatch.filter(filenames, filename_pattern):
 			matches.append(os.path.join(root, filename))
 
@@ -126,7 +172,7 @@ def find_tpf_files(rootdir, starid=None, sector=None, camera=None, ccd=None, fin
 	# Do a recursive search in the directory, finding all files that match the pattern:
 	breakout = False
 	matches = []
-	for root, dirnames, filenames in os.walk(rootdir, followlinks=True):
+	for root, dirnames, filenames in _walk(rootdir):
 		for filename in filenames:
 			if fnmatch.fnmatch(filename, filename_pattern) or fnmatch.fnmatch(filename, filename_pattern2):
 				fpath = os.path.join(root, filename)
@@ -166,13 +212,18 @@ def find_hdf5_files(rootdir, sector=None, camera=None, ccd=None):
 	if not isinstance(camera, (list, tuple)): camera = (1,2,3,4) if camera is None else (camera,)
 	if not isinstance(ccd, (list, tuple)): ccd = (1,2,3,4) if ccd is None else (ccd,)
 
+	try:
+		filenames = _list_folder(rootdir)[1]
+	except OSError:
+		return []
+
 	filelst = []
 	for sector, camera, ccd in itertools.product(sector, camera, ccd):
-		filelst += glob.glob(os.path.join(rootdir, 'sector{0:s}_camera{1:d}_ccd{2:d}.hdf5'.format(
+		filelst += [os.path.join(rootdir, fname) for fname in fnmatch.filter(filenames, 'sector{0:s}_camera{1:d}_ccd{2:d}.hdf5'.format(
 			'???' if sector is None else '%03d' % sector,
 			camera,
 			ccd
-		)))
+		))]
 
 	return filelst
 
@@ -195,13 +246,18 @@ def find_catalog_files(rootdir, sector=None, camera=None, ccd=None):
 	if not isinstance(camera, (list, tuple)): camera = (1,2,3,4) if camera is None else (camera,)
 	if not isinstance(ccd, (list, tuple)): ccd = (1,2,3,4) if ccd is None else (ccd,)
 
+	try:
+		filenames = _list_folder(rootdir)[1]
+	except OSError:
+		return []
+
 	filelst = []
 	for sector, camera, ccd in itertools.product(sector, camera, ccd):
-		filelst += glob.glob(os.path.join(rootdir, 'catalog_sector{0:s}_camera{1:d}_ccd{2:d}.sqlite'.format(
+		filelst += [os.path.join(rootdir, fname) for fname in fnmatch.filter(filenames, 'catalog_sector{0:s}_camera{1:d}_ccd{2:d}.sqlite'.format(
 			'???' if sector is None else '%03d' % sector,
 			camera,
 			ccd
-		)))
+		))]
 
 	return filelst
 
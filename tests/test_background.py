@@ -4,6 +4,7 @@
 .. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
 """
 
+import numpy as np
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -31,6 +32,27 @@ def test_background():
 	assert(bck.shape == img.shape)
 	assert(mask.shape == img.shape)
 
+#------------------------------------------------------------------------------
+def test_background_strips():
+	"""Test of background estimator split into strips"""
+
+	INPUT_DIR = os.path.join(os.path.dirname(__file__), 'input', 'images')
+	fname = find_ffi_files(INPUT_DIR)[0]
+	img = load_ffi_fits(fname)
+
+	# Estimate the background in one go and split into strips:
+	bck, mask = fit_background(fname)
+	bck_strips, mask_strips = fit_background(fname, strips=4)
+
+	# Check the sizes of the returned images:
+	assert(bck_strips.shape == img.shape)
+	assert(np.all(mask_strips == mask))
+
+	# Padding the strips should make the results practically identical:
+	indx = np.isfinite(bck)
+	np.testing.assert_allclose(bck_strips[indx], bck[indx], rtol=1e-2)
+
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
 	test_background()
+	test_background_strips()
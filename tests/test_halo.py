@@ -15,6 +15,7 @@ except ImportError:
 	from backports.tempfile import TemporaryDirectory
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry import HaloPhotometry, STATUS
+from photometry.halo.halo_photometry import _find_single_gap
 import logging
 import pytest
 
@@ -49,6 +50,23 @@ def test_halo():
 
 				print("Passed Tests for %s" % datasource)
 
+#------------------------------------------------------------------------------
+def test_halo_find_single_gap():
+
+	# Timeseries with a single gap in the middle:
+	t = np.concatenate((np.arange(0, 10, 0.02), np.arange(11, 21, 0.02)))
+	indx = _find_single_gap(t, t[0], t[-1] - t[0])
+	assert indx == 499
+	assert t[indx] < 10.5 < t[indx+1]
+
+	# Gap too close to the edge:
+	t = np.concatenate((np.arange(0, 2, 0.02), np.arange(3, 21, 0.02)))
+	assert _find_single_gap(t, t[0], t[-1] - t[0]) == -1
+
+	# Two gaps in the middle:
+	t = np.concatenate((np.arange(0, 8, 0.02), np.arange(9, 12, 0.02), np.arange(13, 21, 0.02)))
+	assert _find_single_gap(t, t[0], t[-1] - t[0]) == -1
+
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
 
@@ -60,4 +78,5 @@ if __name__ == '__main__':
 	if not logger_phot.hasHandlers(): logger_phot.addHandler(console)
 	logger_phot.setLevel(logging.INFO)
 
+	test_halo_find_single_gap()
 	test_halo()
@@ -12,6 +12,9 @@ import logging
 import h5py
 import os
 import numpy as np
+import warnings
+import functools
+import multiprocessing
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry import prepare
@@ -91,7 +94,116 @@ def test_prepare_photometry():
 				assert hdf['backgrounds/' + dset].shape == img_size, "BACKGROUNDS dset=" + dset + " does not have the correct size"
 				assert hdf['pixel_flags/' + dset].shape == img_size, "PIXEL_FLAGS dset=" + dset + " does not have the correct size"
 
+#----------------------------------------------------------------------
+def test_iterate_time_smoothed():
+	"""Test that the time-smoothed backgrounds are the mean of the finite values in the window"""
+
+	rng = np.random.RandomState(42)
+	data = rng.normal(size=(7, 10, 12)).astype('float32')
+	data[1, 2, 3] = np.nan
+	data[2, 2, 3] = np.inf
+	data[3, 5, :] = np.nan
+	data[2:5, 0, 0] = np.nan
+
+	w = 1
+	finite = np.where(np.isfinite(data), data, np.nan)
+	expected = np.empty_like(data)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		for k in range(data.shape[0]):
+			expected[k] = np.nanmean(finite[max(k-w, 0):k+w+1], axis=0)
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		with h5py.File(os.path.join(tmpdir, 'test.hdf5'), 'w') as hdf:
+			dset = hdf.create_dataset('backgrounds_unsmoothed', data=data)
+
+			# All frames:
+			smoothed = {k: bck.copy() for k, bck in prepare._iterate_time_smoothed(dset, w)}
+			assert sorted(smoothed.keys()) == list(range(data.shape[0]))
+			for k, bck in smoothed.items():
+				np.testing.assert_allclose(bck, expected[k], rtol=1e-5, atol=1e-6, equal_nan=True)
+
+			# Only some of the frames, as when resuming:
+			frames = [0, 3, 4, 6]
+			smoothed = {k: bck.copy() for k, bck in prepare._iterate_time_smoothed(dset, w, frames=frames)}
+			assert sorted(smoothed.keys()) == frames
+			for k, bck in smoothed.items():
+				np.testing.assert_allclose(bck, expected[k], rtol=1e-5, atol=1e-6, equal_nan=True)
+
+	# Pixel which is never finite in the window should be NaN:
+	assert np.isnan(expected[3, 0, 0])
+
+#----------------------------------------------------------------------
+def test_require_unsmoothed_backgrounds():
+	"""Test creating, resizing and converting the unsmoothed backgrounds in the temp file"""
+
+	img_shape = (8, 6)
+	with tempfile.TemporaryDirectory() as tmpdir:
+		with h5py.File(os.path.join(tmpdir, 'test.tmp.hdf5'), 'w') as hdftmp:
+			# Temp-file in the old format, with one dataset per background:
+			grp = hdftmp.create_group('backgrounds_unsmoothed')
+			for k in range(3):
+				grp.create_dataset('%04d' % k, data=np.full(img_shape, k, dtype='float32'))
+
+			# The old backgrounds should be copied into the new dataset:
+			dset = prepare._require_unsmoothed_backgrounds(hdftmp, 4, img_shape, (4, 4))
+			assert isinstance(hdftmp['backgrounds_unsmoothed'], h5py.Dataset)
+			assert 'backgrounds_unsmoothed_old' not in hdftmp
+			assert dset.shape == (4,) + img_shape
+			assert dset.attrs['completed'] == 3
+			for k in range(3):
+				np.testing.assert_array_equal(dset[k], k)
+			assert np.all(np.isnan(dset[3]))
+
+			# More files added to the sector:
+			dset = prepare._require_unsmoothed_backgrounds(hdftmp, 6, img_shape, (4, 4))
+			assert dset.shape == (6,) + img_shape
+			assert dset.attrs['completed'] == 3
+			np.testing.assert_array_equal(dset[2], 2)
+
+#----------------------------------------------------------------------
+def _fake_background(shape, seed):
+	# Deterministic stand-in for fit_background, which can be pickled to the workers:
+	rng = np.random.RandomState(seed)
+	bck = rng.normal(size=shape).astype('float32')
+	return bck, bck > 0.5
+
+#----------------------------------------------------------------------
+@pytest.mark.skipif(prepare.SharedMemory is None, reason="Shared memory is not available")
+def test_iterate_backgrounds_shm(monkeypatch):
+	"""Test that backgrounds returned through shared memory match the serial results"""
+
+	shape = (17, 23)
+	files = list(range(11))
+	func = functools.partial(_fake_background, shape)
+	expected = list(map(func, files))
+
+	def check(results):
+		results = list(results)
+		assert len(results) == len(expected)
+		for (bck, mask), (bck_expected, mask_expected) in zip(results, expected):
+			np.testing.assert_array_equal(bck, bck_expected)
+			np.testing.assert_array_equal(mask, mask_expected)
+
+	with multiprocessing.Pool(2) as pool:
+		# Windows both smaller and larger than the number of files:
+		for window in (1, 3, 20):
+			check(prepare._iterate_backgrounds_shm(pool, func, files, shape, window))
+
+		# Falling back to pickling if shared memory could not be allocated:
+		def failing_shared_memory(*args, **kwargs):
+			raise OSError("No space left on device")
+		monkeypatch.setattr(prepare, 'SharedMemory', failing_shared_memory)
+		check(prepare._iterate_backgrounds_shm(pool, func, files, shape, 4))
+
+		# ...or if there is not enough free shared memory:
+		monkeypatch.undo()
+		monkeypatch.setattr(prepare, '_shared_memory_available', lambda: 100)
+		check(prepare._iterate_backgrounds_shm(pool, func, files, shape, 4))
+
 #----------------------------------------------------------------------
 if __name__ == '__main__':
 	test_prepare_photometry_invalid_input_dir()
+	test_require_unsmoothed_backgrounds()
+	test_iterate_time_smoothed()
 	test_prepare_photometry()
@@ -56,5 +56,14 @@ def test_taskmanager():
 
 		assert(task1_status == STATUS.STARTED.value)
 
+		# Get specific tasks by their priority. The started task is no longer due:
+		assert(tm.get_task(priority=3)['priority'] == 3)
+		assert(tm.get_task(priority=1) is None)
+
+		# The priorities of all remaining tasks, in order:
+		priorities = tm.get_pending_priorities()
+		assert(len(priorities) == numtasks - 1)
+		assert(priorities[:2] == [2, 3])
+
 if __name__ == '__main__':
 	test_taskmanager()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of tessphot.
+
+.. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
+"""
+
+import pytest
+import sys
+import os
+import os.path
+import tempfile
+import importlib
+from collections import OrderedDict
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry import tessphot, tessphot_batch, tessphot_chunk, tessphot_many, dask_tessphot, PhotResult, BasePhotometry, STATUS
+
+# The module is shadowed by the tessphot function in the package namespace:
+tessphot_module = importlib.import_module('photometry.tessphot')
+
+INPUT_DIR = os.path.join(os.path.dirname(__file__), 'input')
+DUMMY_TARGET = 260795451
+DUMMY_KWARG = {'sector': 1, 'camera': 3, 'ccd': 2}
+
+#------------------------------------------------------------------------------
+class FakePhotometry(object):
+	"""Stand-in for a photometry object, with a fixed outcome"""
+	def __init__(self, starid, status=STATUS.OK, target_tmag=10.0, contamination=0.0):
+		self.starid = starid
+		self.status = status
+		self.target_tmag = target_tmag
+		self._details = {'contamination': contamination}
+
+#------------------------------------------------------------------------------
+def test_tessphot_invalid_method():
+	"""Test that tessphot rejects unknown methods"""
+
+	with pytest.raises(ValueError):
+		tessphot(method='not-a-method', starid=182092046, input_folder=INPUT_DIR)
+
+#------------------------------------------------------------------------------
+def test_tessphot_dead_configs(monkeypatch):
+	"""Test that constructors failing because of their arguments are not retried"""
+
+	monkeypatch.setattr(tessphot_module, '_dead_configs', OrderedDict())
+
+	class FailingPhotometry(object):
+		calls = 0
+		error = ValueError
+		def __init__(self, *args, **kwargs):
+			FailingPhotometry.calls += 1
+			raise FailingPhotometry.error("Failed")
+
+	# Errors caused by the arguments are only tried once, unless forced:
+	pho = tessphot_module._try_photometry(FailingPhotometry, starid=DUMMY_TARGET)
+	assert pho.status == STATUS.ERROR
+	assert 'ValueError' in pho._details['errors'][0]
+	pho = tessphot_module._try_photometry(FailingPhotometry, starid=DUMMY_TARGET)
+	assert pho.status == STATUS.ERROR
+	assert 'ValueError' in pho._details['errors'][0]
+	assert FailingPhotometry.calls == 1
+	pho = tessphot_module._try_photometry(FailingPhotometry, starid=DUMMY_TARGET, force=True)
+	assert pho.status == STATUS.ERROR
+	assert FailingPhotometry.calls == 2
+
+	# Possibly transient errors are tried every time:
+	FailingPhotometry.calls = 0
+	FailingPhotometry.error = OSError
+	for k in range(2):
+		pho = tessphot_module._try_photometry(FailingPhotometry, starid=1)
+		assert pho.status == STATUS.ERROR
+	assert FailingPhotometry.calls == 2
+
+	# An invalid datasource is remembered when running through tessphot:
+	monkeypatch.delenv('TESSPHOT_CACHE', raising=False)
+	with tempfile.TemporaryDirectory() as OUTPUT_DIR:
+		kwargs = dict(starid=DUMMY_TARGET, input_folder=INPUT_DIR, output_folder=OUTPUT_DIR, datasource='invalid')
+		pho = tessphot(method='aperture', **kwargs)
+		assert pho.status == STATUS.ERROR
+		assert tessphot_module._config_key(tessphot_module.AperturePhotometry, (), kwargs) in tessphot_module._dead_configs
+
+#------------------------------------------------------------------------------
+def test_tessphot_batch(monkeypatch):
+	"""Test that tessphot_batch runs all stars in order"""
+
+	# Invalid methods are rejected right away, not when iterating:
+	for method in (None, 'not-a-method'):
+		with pytest.raises(ValueError):
+			tessphot_batch([DUMMY_TARGET], method=method)
+
+	calls = []
+	def fake_run(starid, save_async=False, **kwargs):
+		calls.append((starid, save_async, kwargs.get('cache')))
+		return tessphot_module._completed(FakePhotometry(starid))
+
+	monkeypatch.setitem(tessphot_module._RUNNERS, 'aperture', fake_run)
+	starids = [3, 1, 2]
+	phos = list(tessphot_batch(starids, method='aperture', input_folder=INPUT_DIR))
+	assert [pho.starid for pho in phos] == starids
+	assert calls == [(starid, True, None) for starid in starids]
+
+	# The cache setting is left to the caller:
+	del calls[:]
+	list(tessphot_batch([1], method='aperture', cache='none'))
+	assert calls == [(1, True, 'none')]
+
+	# Running on real data gives finished photometry with the lightcurve saved:
+	monkeypatch.undo()
+	with tempfile.TemporaryDirectory() as OUTPUT_DIR:
+		phos = list(tessphot_batch([DUMMY_TARGET], method='aperture', input_folder=INPUT_DIR, output_folder=OUTPUT_DIR, **DUMMY_KWARG))
+		assert len(phos) == 1
+		assert isinstance(phos[0], BasePhotometry)
+		assert phos[0].starid == DUMMY_TARGET
+		assert phos[0].status in (STATUS.OK, STATUS.WARNING)
+		assert os.path.isfile(os.path.join(OUTPUT_DIR, phos[0]._details['filepath_lightcurve']))
+
+#------------------------------------------------------------------------------
+def test_tessphot_cache():
+	"""Test the result cache of tessphot"""
+
+	# Keep track of when the photometry is actually run:
+	runs = []
+	run_aperture = tessphot_module._RUNNERS['aperture']
+	def counting_run(*args, **kwargs):
+		runs.append(kwargs['starid'])
+		return run_aperture(*args, **kwargs)
+
+	old_cache = os.environ.get('TESSPHOT_CACHE')
+	with tempfile.TemporaryDirectory() as tmpdir:
+		os.environ['TESSPHOT_CACHE'] = os.path.join(tmpdir, 'cache.sqlite')
+		tessphot_module._reset_cache_db()
+		tessphot_module._RUNNERS['aperture'] = counting_run
+		try:
+			kwargs = dict(starid=DUMMY_TARGET, input_folder=INPUT_DIR, output_folder=os.path.join(tmpdir, 'output1'), **DUMMY_KWARG)
+
+			def run(**extra):
+				nruns = len(runs)
+				pho = tessphot(method='aperture', **dict(kwargs, **extra))
+				return pho, len(runs) > nruns
+
+			# The first run should run the photometry:
+			pho, ran = run()
+			assert ran
+			assert isinstance(pho, BasePhotometry)
+			assert pho.status in (STATUS.OK, STATUS.WARNING)
+
+			# Asking for the summary should give the cached result:
+			res, ran = run(return_summary=True)
+			assert not ran
+			assert isinstance(res, PhotResult)
+			assert res.starid == DUMMY_TARGET
+			assert res.status == pho.status
+			assert res.path == pho._details['filepath_lightcurve']
+
+			# The photometry object can not come from the cache, so it is always run:
+			pho, ran = run()
+			assert ran
+			assert isinstance(pho, BasePhotometry)
+
+			# Forcing the run, or changing the version or output folder, should run it again:
+			assert run(return_summary=True, force=True)[1]
+			assert run(return_summary=True, version=4)[1]
+			kwargs['output_folder'] = os.path.join(tmpdir, 'output2')
+			res, ran = run(return_summary=True)
+			assert ran
+			assert not run(return_summary=True)[1]
+
+			# If the lightcurve has been deleted, the photometry should be run again:
+			os.remove(os.path.join(kwargs['output_folder'], res.path))
+			assert run(return_summary=True)[1]
+		finally:
+			tessphot_module._RUNNERS['aperture'] = run_aperture
+			tessphot_module._reset_cache_db()
+			if old_cache is None:
+				del os.environ['TESSPHOT_CACHE']
+			else:
+				os.environ['TESSPHOT_CACHE'] = old_cache
+
+#------------------------------------------------------------------------------
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Requires os.fork")
+def test_tessphot_cache_fork():
+	"""Test that a forked child does not inherit a held cache lock"""
+
+	with tessphot_module._cache_lock:
+		pid = os.fork()
+		if pid == 0: # pragma: no cover
+			# In the child, the lock should be free:
+			acquired = tessphot_module._cache_lock.acquire(timeout=5)
+			os._exit(0 if acquired else 1)
+
+	_, status = os.waitpid(pid, 0)
+	assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+#------------------------------------------------------------------------------
+def test_tessphot_cache_locked(caplog):
+	"""Test that a locked result cache does not stop the processing"""
+
+	key = (DUMMY_TARGET, 'aperture', 'ffi', 1, '/nonexistent', -1, 0)
+
+	class LockedDatabase(object):
+		def execute(self, *args):
+			raise tessphot_module.sqlite3.OperationalError("database is locked")
+
+	old_db = tessphot_module._cache_db
+	tessphot_module._cache_db = LockedDatabase()
+	try:
+		# Reading a locked cache is a miss, and writing to it is skipped:
+		assert tessphot_module._cache_lookup(key, 0, INPUT_DIR) is None
+		tessphot_module._cache_store(key, 0, PhotResult(STATUS.OK, DUMMY_TARGET, None, {}))
+	finally:
+		tessphot_module._cache_db = old_db
+
+	assert 'Could not write to result cache' in caplog.text
+
+#------------------------------------------------------------------------------
+def test_tessphot_chunk(monkeypatch):
+	"""Test that tessphot_chunk groups tasks by CCD and returns result dicts"""
+
+	monkeypatch.delenv('TESSPHOT_CACHE', raising=False)
+	calls = []
+	def fake_run(starid, save_async=False, **kwargs):
+		calls.append((starid, kwargs['camera'], kwargs['ccd']))
+		status = STATUS.ERROR if starid == 4 else STATUS.OK
+		return tessphot_module._completed(FakePhotometry(starid, status=status))
+
+	cleared = []
+	monkeypatch.setitem(tessphot_module._RUNNERS, 'aperture', fake_run)
+	monkeypatch.setattr(tessphot_module.BasePhotometry, 'clear_cache', lambda: cleared.append(True))
+
+	tasks = [
+		{'priority': 1, 'starid': 1, 'method': 'aperture', 'sector': 1, 'camera': 1, 'ccd': 1},
+		{'priority': 2, 'starid': 2, 'method': 'aperture', 'sector': 1, 'camera': 3, 'ccd': 2},
+		{'priority': 3, 'starid': 3, 'method': 'aperture', 'sector': 1, 'camera': 1, 'ccd': 1},
+		{'priority': 4, 'starid': 4, 'method': 'aperture', 'sector': 1, 'camera': 3, 'ccd': 2},
+	]
+	results = list(tessphot_chunk(tasks, input_folder=INPUT_DIR))
+
+	# The stars of each CCD are run together, in the order they were given:
+	assert calls == [(1, 1, 1), (3, 1, 1), (2, 3, 2), (4, 3, 2)]
+	assert [result['priority'] for result in results] == [1, 3, 2, 4]
+	for result, task in zip(results, [tasks[0], tasks[2], tasks[1], tasks[3]]):
+		for key, value in task.items():
+			assert result[key] == value
+		assert result['time'] >= 0
+		assert isinstance(result['details'], dict)
+	assert [result['status'] for result in results] == [STATUS.OK, STATUS.OK, STATUS.OK, STATUS.ERROR]
+
+	# The cache is cleared after every group, also when the last star failed:
+	assert len(cleared) == 2
+
+#------------------------------------------------------------------------------
+def test_tessphot_chunk_cache(monkeypatch):
+	"""Test that the stars in a group of tessphot_chunk share the cached CCD data"""
+
+	# Count how many times data of a CCD is loaded into the shared cache:
+	class CountingCache(dict):
+		def __init__(self):
+			super(CountingCache, self).__init__()
+			self.loads = 0
+		def __setitem__(self, key, value):
+			self.loads += 1
+			super(CountingCache, self).__setitem__(key, value)
+
+	# The module is shadowed by the class in the package namespace:
+	base_module = importlib.import_module('photometry.BasePhotometry')
+	cache = CountingCache()
+	monkeypatch.setattr(base_module, 'hdf5_cache', cache)
+
+	tasks = [dict(priority=k+1, starid=starid, method='aperture', **DUMMY_KWARG) for k, starid in enumerate((DUMMY_TARGET, 267211065))]
+	with tempfile.TemporaryDirectory() as OUTPUT_DIR:
+		results = list(tessphot_chunk(tasks, input_folder=INPUT_DIR, output_folder=OUTPUT_DIR))
+
+	assert [result['starid'] for result in results] == [DUMMY_TARGET, 267211065]
+
+	# Only the first star loaded the data of the CCD, and the cache was cleared afterwards:
+	assert cache.loads == 1
+	assert base_module.hdf5_cache is not cache and len(base_module.hdf5_cache) == 0
+
+#------------------------------------------------------------------------------
+@pytest.mark.parametrize('tmag,contamination,fallback_status,expected', [
+	(5.0, 0.0, STATUS.OK, 'HaloPhotometry'),
+	(10.0, 0.9, STATUS.OK, 'PSFPhotometry'),
+	(10.0, 0.1, STATUS.OK, None),
+	(5.0, 0.0, STATUS.ERROR, 'HaloPhotometry'),
+])
+def test_tessphot_fallback(monkeypatch, tmag, contamination, fallback_status, expected):
+	"""Test the choice of fallback method in the dynamical scheme"""
+
+	monkeypatch.delenv('TESSPHOT_CACHE', raising=False)
+	aperture = FakePhotometry(DUMMY_TARGET, status=STATUS.WARNING, target_tmag=tmag, contamination=contamination)
+	fallback = FakePhotometry(DUMMY_TARGET, status=fallback_status)
+	tried = []
+
+	def fake_try_photometry(PhotClass, *args, **kwargs):
+		tried.append(PhotClass.__name__)
+		return fallback
+
+	monkeypatch.setitem(tessphot_module._RUNNERS, None, lambda *args, **kwargs: aperture)
+	monkeypatch.setattr(tessphot_module, '_try_photometry', fake_try_photometry)
+
+	pho = tessphot(starid=DUMMY_TARGET, input_folder=INPUT_DIR)
+	if expected is None:
+		assert tried == []
+	else:
+		assert tried == [expected]
+
+	# The fallback is only used if it went well:
+	if expected is not None and fallback_status == STATUS.OK:
+		assert pho is fallback
+	else:
+		assert pho is aperture
+
+	# Aperture photometry without a warning does not need a fallback:
+	del tried[:]
+	aperture.status = STATUS.OK
+	assert tessphot(starid=DUMMY_TARGET, input_folder=INPUT_DIR) is aperture
+	assert tried == []
+
+#------------------------------------------------------------------------------
+def test_tessphot_summary():
+	"""Test the lightweight summary returned with return_summary=True"""
+
+	with tempfile.TemporaryDirectory() as OUTPUT_DIR:
+		res = tessphot(method='aperture', starid=DUMMY_TARGET, input_folder=INPUT_DIR, output_folder=OUTPUT_DIR, return_summary=True, **DUMMY_KWARG)
+		assert isinstance(res, PhotResult)
+		assert res.starid == DUMMY_TARGET
+		assert res.status in (STATUS.OK, STATUS.WARNING)
+		assert res.path == res.details['filepath_lightcurve']
+		assert res._details is res.details
+		assert os.path.isfile(os.path.join(OUTPUT_DIR, res.path))
+
+		# Failures are also summarised:
+		res = tessphot(method='aperture', starid=DUMMY_TARGET, input_folder=INPUT_DIR, output_folder=OUTPUT_DIR, datasource='invalid', return_summary=True)
+		assert isinstance(res, PhotResult)
+		assert res.status == STATUS.ERROR
+		assert res.path is None
+
+#------------------------------------------------------------------------------
+def test_tessphot_many(monkeypatch):
+	"""Test that tessphot_many returns a result for every task"""
+
+	calls = []
+	def fake_tessphot(**kwargs):
+		calls.append(kwargs)
+		return PhotResult(STATUS.OK, kwargs['starid'], None, {'version': kwargs.get('version')})
+
+	pools = []
+	class FakePool(object):
+		def __init__(self, processes):
+			pools.append(processes)
+		def __enter__(self):
+			return self
+		def __exit__(self, *args):
+			pass
+		def imap_unordered(self, func, iterable, chunksize=1):
+			# The results do not come back in the same order as the tasks:
+			return reversed([func(item) for item in iterable])
+
+	monkeypatch.setattr(tessphot_module, 'tessphot', fake_tessphot)
+	monkeypatch.setattr(tessphot_module.multiprocessing, 'Pool', FakePool)
+
+	tasks = [{'priority': k+1, 'starid': 100+k, 'method': 'aperture', 'tmag': 10.0} for k in range(5)]
+
+	def check(results):
+		assert len(results) == len(tasks)
+		for result, task in zip(sorted(results, key=lambda r: r['priority']), tasks):
+			for key, value in task.items():
+				assert result[key] == value
+			assert result['status'] == STATUS.OK
+			assert result['time'] >= 0
+			assert result['details'] == {'version': 4}
+
+		# Only the arguments for tessphot are passed on:
+		for kwargs in calls:
+			assert 'priority' not in kwargs and 'tmag' not in kwargs
+			assert kwargs['return_summary']
+		del calls[:]
+
+	# Running the tasks in this process:
+	check(list(tessphot_many(tasks, nprocs=1, version=4)))
+	assert pools == []
+
+	# The number of processes is taken from SLURM, if it is not given:
+	monkeypatch.setenv('SLURM_CPUS_PER_TASK', '3')
+	check(list(tessphot_many(iter(tasks), version=4)))
+	assert pools == [3]
+
+	# ...but an explicit number wins:
+	check(list(tessphot_many(tasks, nprocs=2, version=4)))
+	assert pools == [3, 2]
+
+#------------------------------------------------------------------------------
+def test_dask_tessphot(monkeypatch):
+	"""Test running tasks on a local Dask cluster"""
+
+	distributed = pytest.importorskip('distributed')
+
+	def fake_tessphot(**kwargs):
+		return PhotResult(STATUS.OK, kwargs['starid'], None, {'version': kwargs.get('version')})
+
+	# The workers are threads in this process, so they see the fake tessphot:
+	monkeypatch.setattr(tessphot_module, 'tessphot', fake_tessphot)
+
+	tasks = [{'priority': k+1, 'starid': 100+k, 'method': 'aperture', 'tmag': 10.0} for k in range(5)]
+	with distributed.LocalCluster(n_workers=2, threads_per_worker=1, processes=False, dashboard_address=None, resources={'mem': 2}) as cluster:
+		with distributed.Client(cluster) as client:
+			results = list(dask_tessphot(tasks, client=client, resources={'mem': 1}, version=4))
+
+			# A client given by the caller is left open:
+			assert client.status == 'running'
+
+	assert len(results) == len(tasks)
+	for result, task in zip(sorted(results, key=lambda r: r['priority']), tasks):
+		for key, value in task.items():
+			assert result[key] == value
+		assert result['status'] == STATUS.OK
+		assert result['details'] == {'version': 4}
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+	test_tessphot_invalid_method()
+	test_tessphot_cache()
+	test_tessphot_summary()
\ No newline at end of file
@@ -6,8 +6,12 @@
 
 import sys
 import os
+import glob
+import fnmatch
+import tempfile
 import numpy as np
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry import utilities
 from photometry.utilities import (move_median_central, find_ffi_files, find_tpf_files,
 	find_hdf5_files, find_catalog_files, load_ffi_fits,
 	sphere_distance, radec_to_cartesian, cartesian_to_radec,
@@ -157,6 +161,70 @@ def test_rms_timescale():
 	print(rms)
 	np.testing.assert_allclose(rms, 0)
 
+#----------------------------------------------------------------------
+def test_find_files_cached_listing():
+	"""Test that the cached directory listings give the same files as searching the disk"""
+
+	def touch(*path):
+		open(os.path.join(*path), 'w').close()
+
+	def age(rootdir):
+		# Make the directories look old, so their listings are cached:
+		for root, dirnames, filenames in os.walk(rootdir):
+			os.utime(root, (1e9, 1e9))
+
+	def walk_matches(rootdir, pattern):
+		# The search the way it was done before the listings were cached:
+		matches = []
+		for root, dirnames, filenames in os.walk(rootdir, followlinks=True):
+			matches += [os.path.join(root, f) for f in fnmatch.filter(filenames, pattern)]
+		return sorted(matches)
+
+	ffi_pattern = 'tess*-s0001-?-?-????-[xsab]_ffic.fits*'
+	tpf_pattern = 'tess*-s????-*-????-[xsab]_tp.fits*'
+
+	with tempfile.TemporaryDirectory() as rootdir:
+		os.makedirs(os.path.join(rootdir, 'ffi', 'camera1'))
+		os.makedirs(os.path.join(rootdir, 'other', 'tpf'))
+		touch(rootdir, 'ffi', 'camera1', 'tess2018206192942-s0001-1-1-0120-s_ffic.fits')
+		touch(rootdir, 'ffi', 'tess2018206192942-s0001-3-2-0120-s_ffic.fits.gz')
+		touch(rootdir, 'other', 'tpf', 'tess2018206045859-s0001-0000000267211065-0120-s_tp.fits')
+		touch(rootdir, 'sector001_camera1_ccd1.hdf5')
+		touch(rootdir, 'catalog_sector001_camera1_ccd1.sqlite')
+		touch(rootdir, 'notes.txt')
+		if hasattr(os, 'symlink'):
+			# Symlinked directories are followed:
+			os.symlink(os.path.join(rootdir, 'other', 'tpf'), os.path.join(rootdir, 'linked'))
+		age(rootdir)
+
+		for k in range(2):
+			assert sorted(find_ffi_files(rootdir, sector=1)) == walk_matches(rootdir, ffi_pattern)
+			assert sorted(find_tpf_files(rootdir)) == walk_matches(rootdir, tpf_pattern)
+			assert sorted(find_hdf5_files(rootdir)) == sorted(glob.glob(os.path.join(rootdir, 'sector*_camera*_ccd*.hdf5')))
+			assert sorted(find_catalog_files(rootdir)) == sorted(glob.glob(os.path.join(rootdir, 'catalog_sector*_camera*_ccd*.sqlite')))
+
+		assert len(find_ffi_files(rootdir, sector=1)) == 2
+		assert len(find_tpf_files(rootdir)) == (2 if hasattr(os, 'symlink') else 1)
+
+		# The second time around, the listings came from the cache:
+		hits = utilities._list_folder_cached.cache_info().hits
+		find_ffi_files(rootdir)
+		assert utilities._list_folder_cached.cache_info().hits > hits
+
+		# Files added after the first search are found, also in sub-directories:
+		touch(rootdir, 'sector001_camera3_ccd2.hdf5')
+		touch(rootdir, 'ffi', 'camera1', 'tess2018206195942-s0001-1-1-0120-s_ffic.fits')
+		assert len(find_hdf5_files(rootdir)) == 2
+		assert len(find_hdf5_files(rootdir, camera=3, ccd=2)) == 1
+		assert len(find_ffi_files(rootdir, sector=1)) == 3
+		assert sorted(find_ffi_files(rootdir, sector=1)) == walk_matches(rootdir, ffi_pattern)
+
+		# ...and removed files are gone, also when the directories are old:
+		age(rootdir)
+		find_hdf5_files(rootdir)
+		os.remove(os.path.join(rootdir, 'sector001_camera3_ccd2.hdf5'))
+		assert len(find_hdf5_files(rootdir)) == 1
+
 #----------------------------------------------------------------------
 if __name__ == '__main__':
 	test_move_median_central()
@@ -164,6 +232,7 @@ if __name__ == '__main__':
 	test_find_tpf_files()
 	test_find_hdf5_files()
 	test_find_catalog_files()
+	test_find_files_cached_listing()
 	test_load_ffi_files()
 	test_sphere_distance()
 	test_coordtransforms()